@@ -2,15 +2,40 @@
 const vscode = require("vscode");
 
 const API_URL = "http://127.0.0.1:8005/generate";
+const INGEST_URL = "http://127.0.0.1:8005/ingest";
+
+// Overlay owner for /ingest and /generate. With an API key the server takes the
+// user bound to the key, so USER_ID is only sent without one.
+// The repo id must match the one CI ingests the main index under (Jenkins JOB_NAME);
+// defaults to the folder name.
+const USER_ID = process.env.LLM_COPILOT_USER || vscode.env.machineId;
+const REPO_ID = process.env.LLM_COPILOT_REPO || "";
+// Sent as X-API-Key when the server sets INGEST_API_KEYS (otherwise overlays are loopback-only).
+const API_KEY = process.env.LLM_COPILOT_API_KEY || "";
+
+function apiHeaders() {
+  const headers = { "Content-Type": "application/json" };
+  if (API_KEY) headers["X-API-Key"] = API_KEY;
+  return headers;
+}
+
+function withUser(payload) {
+  return API_KEY ? payload : { ...payload, user: USER_ID };
+}
+// Larger files are not sent (server default INGEST_MAX_CHARS).
+const INGEST_MAX_CHARS = 1000000;
 
 const PREFIX_MAX_CHARS = 12000;
 const SUFFIX_MAX_CHARS = 4000;
 
+// n sampled candidates share one prefill on the server and come back ranked;
+// each becomes an inline item the user can cycle through (Alt+] / Alt+[).
 const DEFAULT_GEN = {
   max_new_tokens: 96,
-  temperature: 0.0,
-  top_p: 1.0,
-  do_sample: false,
+  temperature: 0.4,
+  top_p: 0.95,
+  do_sample: true,
+  n: 3,
   extra_stop: ["\n\n\ndef ", "\n\nclass ", "```"],
 };
 
@@ -51,7 +76,7 @@ function getPrefixSuffix(document, position) {
 async function callApi(payload, signal) {
   const res = await fetch(API_URL, {
     method: "POST",
-    headers: { "Content-Type": "application/json" },
+    headers: apiHeaders(),
     body: JSON.stringify(payload),
     signal,
   });
@@ -62,6 +87,31 @@ async function callApi(payload, signal) {
   return res.json();
 }
 
+// Repo id sent to both /ingest and /generate, so overlay files shadow exactly
+// their own (repo, file_path) in the main index.
+function repoFor(uri) {
+  const folder = vscode.workspace.getWorkspaceFolder(uri);
+  return REPO_ID || (folder ? folder.name : "");
+}
+
+// Fire-and-forget: the server debounces and indexes in the background.
+function ingestFile(uri, content) {
+  const repo = repoFor(uri);
+  if (!repo || uri.scheme !== "file") return;
+  if (content !== null && content.length > INGEST_MAX_CHARS) return;
+  const payload = withUser({
+    repo,
+    file_path: vscode.workspace.asRelativePath(uri, false),
+    content,
+    deleted: content === null,
+  });
+  fetch(INGEST_URL, {
+    method: "POST",
+    headers: apiHeaders(),
+    body: JSON.stringify(payload),
+  }).catch((err) => console.warn("[llm] ingest failed:", err));
+}
+
 function cleanCompletion(s) {
   if (!s) return "";
   // remove trailing spaces that can cause odd rendering
@@ -97,19 +147,24 @@ function activate(context) {
         const { prefix, suffix } = getPrefixSuffix(document, position);
         if (!prefix || prefix.trim().length === 0) return [];
 
-        const payload = { prefix, suffix, ...DEFAULT_GEN };
+        const payload = withUser({ prefix, suffix, file_language: document.languageId, ...DEFAULT_GEN });
+        const repo = repoFor(document.uri);
+        if (repo) payload.repo = repo;
 
         console.log("[llm] calling API…");
         const data = await callApi(payload, lastAbort.signal);
-        const completion = cleanCompletion(data?.completion || "");
+        const ranked = data?.candidates?.length ? data.candidates.map((c) => c.completion) : [data?.completion];
 
         // Disarm after one response attempt (prevents repeated calls)
         manualArmed = false;
 
-        if (!completion || completion.trim().length === 0) return [];
+        // best first, as ranked by the server; drop empty and duplicate (after cleaning) candidates
+        const completions = [...new Set(ranked.map((c) => cleanCompletion(c || "")))]
+          .filter((c) => c.trim().length > 0);
+        if (completions.length === 0) return [];
 
         const range = new vscode.Range(position, position);
-        return [new vscode.InlineCompletionItem(completion, range)];
+        return completions.map((c) => new vscode.InlineCompletionItem(c, range));
       } catch (err) {
         if (err && (err.name === "AbortError" || String(err).includes("AbortError"))) {
           return [];
@@ -126,6 +181,14 @@ function activate(context) {
     vscode.languages.registerInlineCompletionItemProvider({ pattern: "**" }, provider)
   );
 
+  // Keep the server-side overlay index in sync with saved / deleted files
+  context.subscriptions.push(
+    vscode.workspace.onDidSaveTextDocument((doc) => ingestFile(doc.uri, doc.getText()))
+  );
+  context.subscriptions.push(
+    vscode.workspace.onDidDeleteFiles((e) => e.files.forEach((uri) => ingestFile(uri, null)))
+  );
+
   // Manual trigger command
   context.subscriptions.push(
     vscode.commands.registerCommand("llm-coding-agent.inlineSuggest", async () => {
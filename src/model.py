@@ -1,15 +1,23 @@
+from torch.profiler import record_function
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
+    DynamicCache,
+    LogitsProcessor,
+    LogitsProcessorList,
     StoppingCriteria,
     StoppingCriteriaList
 )
 
+import asyncio
+import os
 import torch
 
-from typing import List, Optional
+from typing import List, Optional, Tuple, Dict, Any
 from dotenv import load_dotenv
 
+from stopping import CompletionStopper
+
 load_dotenv()
 
 torch.backends.cuda.enable_mem_efficient_sdp(False)
@@ -44,6 +52,28 @@ if specials_to_add:
 model = model.to(device)
 model.eval()
 
+# Total prompt tokens (context + prefix + suffix + FIM markers); also capped by the
+# model's context window minus max_new_tokens.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4096"))
+# Upper shares of the budget for retrieved context and suffix; the prefix gets the
+# rest, and whatever a part does not use is handed to the others.
+CONTEXT_TOKEN_SHARE = float(os.getenv("CONTEXT_TOKEN_SHARE", "0.3"))
+SUFFIX_TOKEN_SHARE = float(os.getenv("SUFFIX_TOKEN_SHARE", "0.2"))
+
+FIM_PREFIX_ID = tokenizer.convert_tokens_to_ids(FIM_PREFIX)
+FIM_SUFFIX_ID = tokenizer.convert_tokens_to_ids(FIM_SUFFIX)
+FIM_MIDDLE_ID = tokenizer.convert_tokens_to_ids(FIM_MIDDLE)
+
+# A context block is header + items joined by CONTEXT_SEP + CONTEXT_CLOSE; pieces are
+# tokenized separately so over-budget items can be dropped without re-tokenizing.
+SYMBOL_CONTEXT_HEADER = '"""\nSYMBOL_CONTEXT (definitions referenced near the cursor)\n'
+RAG_CONTEXT_HEADER = '"""\nRAG_CONTEXT (internal codebase; for reference only)\n'
+CONTEXT_SEP = "\n\n"
+CONTEXT_CLOSE = '\n"""\n\n'
+CONTEXT_SEP_IDS = tokenizer.encode(CONTEXT_SEP, add_special_tokens=False)
+CONTEXT_CLOSE_IDS = tokenizer.encode(CONTEXT_CLOSE, add_special_tokens=False)
+ContextBlock = Tuple[List[int], List[List[int]]]  # (header ids, ids per item)
+
 DEFAULT_STOP_STRINGS: List[str] = [
     "```",
     "\n\n\n",
@@ -65,50 +95,245 @@ def encode_stop_strings(stop_strings: List[str]) -> List[List[int]]:
 class StopOnSequences(StoppingCriteria):
     """
     Stop generation when the tail of input_ids matches any stop-sequence token ids.
-    Works for multi-token stop strings.
+    Works for multi-token stop strings; evaluated per batch row.
     """
     def __init__(self, stop_sequences_token_ids: List[List[int]]):
         super().__init__()
         self.stop_seqs = [seq for seq in stop_sequences_token_ids if seq]
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        if input_ids is None or input_ids.numel() == 0:
-            return False
-        seq = input_ids[0].tolist()
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
         for stop_ids in self.stop_seqs:
             n = len(stop_ids)
-            if n <= len(seq) and seq[-n:] == stop_ids:
-                return True
-        return False
+            if n > input_ids.shape[1]:
+                continue
+            tail = torch.tensor(stop_ids, dtype=input_ids.dtype, device=input_ids.device)
+            done |= (input_ids[:, -n:] == tail).all(dim=1)
+        return done
 
 
-def build_fim_prompt(prefix: str, suffix: str) -> str:
-    prefix = prefix or ""
-    suffix = suffix or ""
-    return f"{FIM_PREFIX}{prefix}{FIM_SUFFIX}{suffix}{FIM_MIDDLE}"
+class TokenLogProbRecorder(LogitsProcessor):
+    """
+    Accumulates the log-prob of each sampled token per row without keeping the
+    per-step logits around. Runs before the sampling warpers, so the log-probs
+    come from the unscaled model distribution.
+    """
+    def __init__(self, prompt_len: int, eos_token_id: int):
+        self.prompt_len = prompt_len
+        self.eos_token_id = eos_token_id
+        self.prev_logprobs: Optional[torch.FloatTensor] = None
+        self.total: Optional[torch.FloatTensor] = None
+        self.count: Optional[torch.FloatTensor] = None
+        self.done: Optional[torch.BoolTensor] = None
+
+    def _collect(self, input_ids: torch.LongTensor) -> None:
+        if self.prev_logprobs is None or input_ids.shape[1] <= self.prompt_len:
+            return
+        tok = input_ids[:, -1]
+        if self.total is None:
+            self.total = torch.zeros(tok.shape[0], dtype=torch.float32, device=tok.device)
+            self.count = torch.zeros_like(self.total)
+            self.done = torch.zeros(tok.shape[0], dtype=torch.bool, device=tok.device)
+        # rows that hit EOS (or were stopped and padded with it) stop counting
+        self.done |= tok == self.eos_token_id
+        active = (~self.done).float()
+        self.total += self.prev_logprobs.gather(1, tok[:, None]).squeeze(1) * active
+        self.count += active
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        with record_function("copilot.logprob_record"):
+            self._collect(input_ids)
+            self.prev_logprobs = torch.log_softmax(scores.float(), dim=-1)
+        return scores
+
+    def finalize(self, sequences: torch.LongTensor) -> List[float]:
+        self._collect(sequences)
+        self.prev_logprobs = None
+        if self.total is None:
+            return [0.0] * sequences.shape[0]
+        return (self.total / self.count.clamp(min=1.0)).tolist()
+
+
+class StopOnStructure(StoppingCriteria):
+    """
+    Stop a row once its generated text hits a CompletionStopper rule
+    (line end, dedent out of the cursor block, stray closer, suffix repeat).
+    """
+    def __init__(self, stopper: CompletionStopper, prompt_len: int):
+        super().__init__()
+        self.stopper = stopper
+        self.prompt_len = prompt_len
 
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        with record_function("copilot.stop_structure"):
+            done = []
+            for row in input_ids[:, self.prompt_len:].tolist():
+                text = tokenizer.decode(row, skip_special_tokens=True)
+                done.append(self.stopper.find_cut(text) is not None)
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
 
-def build_rag_context_block(hits: List[dict]) -> str:
-    if not hits:
-        return ""
 
+def tokenize_with_offsets(text: str) -> Tuple[List[int], Optional[List[Tuple[int, int]]]]:
+    if not text:
+        return [], []
+    if tokenizer.is_fast:
+        enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        return enc["input_ids"], enc["offset_mapping"]
+    return tokenizer.encode(text, add_special_tokens=False), None
+
+
+def keep_tail_tokens(text: str, ids: List[int], offsets, budget: int) -> List[int]:
+    """
+    Last `budget` tokens of `text`, starting at the first full line inside that
+    window (the lines nearest the cursor survive).
+    """
+    if len(ids) <= budget:
+        return ids
+    if budget <= 0:
+        return []
+    start = len(ids) - budget
+    if offsets is not None:
+        for i in range(start, len(ids)):
+            s = offsets[i][0]
+            if s == 0 or text[s - 1] == "\n":
+                return ids[i:]
+    return ids[start:]
+
+
+def keep_head_tokens(text: str, ids: List[int], offsets, budget: int) -> List[int]:
+    """
+    First `budget` tokens of `text`, ending at the last full line inside that window.
+    """
+    if len(ids) <= budget:
+        return ids
+    if budget <= 0:
+        return []
+    if offsets is not None:
+        for i in range(budget, 0, -1):
+            e = offsets[i - 1][1]
+            if e > 0 and text[e - 1] == "\n":
+                return ids[:i]
+    return ids[:budget]
+
+
+def allocate_fim_budget(n_context: int, n_prefix: int, n_suffix: int, budget: int) -> Tuple[int, int, int]:
+    context_b = min(n_context, int(budget * CONTEXT_TOKEN_SHARE))
+    suffix_b = min(n_suffix, int(budget * SUFFIX_TOKEN_SHARE))
+    prefix_b = min(n_prefix, budget - context_b - suffix_b)
+
+    spare = budget - context_b - suffix_b - prefix_b
+    extra = min(spare, n_context - context_b)
+    context_b += extra
+    spare -= extra
+    suffix_b += min(spare, n_suffix - suffix_b)
+    return context_b, prefix_b, suffix_b
+
+
+def tokenize_context_blocks(symbols: Optional[List[dict]], hits: Optional[List[dict]]) -> List[ContextBlock]:
+    # symbol definitions go first: over budget, items are dropped from the end
+    blocks = []
+    for header, items in ((SYMBOL_CONTEXT_HEADER, symbol_context_items(symbols or [])),
+                          (RAG_CONTEXT_HEADER, rag_context_items(hits or []))):
+        if items:
+            blocks.append((
+                tokenizer.encode(header, add_special_tokens=False),
+                [tokenizer.encode(t, add_special_tokens=False) for t in items],
+            ))
+    return blocks
+
+
+def _context_block_len(header: List[int], items: List[List[int]]) -> int:
+    if not items:
+        return 0
+    return len(header) + sum(len(x) for x in items) + len(CONTEXT_SEP_IDS) * (len(items) - 1) + len(CONTEXT_CLOSE_IDS)
+
+
+def fit_context_ids(blocks: List[ContextBlock], budget: Optional[int] = None) -> List[int]:
+    """
+    Context token ids within `budget` (all of it when None): whole hits, then
+    whole symbols, are dropped from the end by their token counts, so every
+    kept item is complete and every block is closed.
+    """
+    kept = [(header, list(items)) for header, items in blocks]
+    total = sum(_context_block_len(h, items) for h, items in kept)
+    if budget is not None:
+        for header, items in reversed(kept):
+            while items and total > budget:
+                last = items.pop()
+                # the block's header and close go with its last item
+                total -= len(last) + (len(CONTEXT_SEP_IDS) if items else len(header) + len(CONTEXT_CLOSE_IDS))
+
+    ids: List[int] = []
+    for header, items in kept:
+        if not items:
+            continue
+        ids += header
+        for i, item in enumerate(items):
+            if i:
+                ids += CONTEXT_SEP_IDS
+            ids += item
+        ids += CONTEXT_CLOSE_IDS
+    return ids
+
+
+def build_fim_input_ids(
+        prefix: str,
+        suffix: str,
+        context_symbols: Optional[List[dict]] = None,
+        context_hits: Optional[List[dict]] = None,
+        budget: int = PROMPT_TOKEN_BUDGET,
+) -> List[int]:
+    """
+    Token-level FIM prompt within `budget` tokens. Prefix and suffix are
+    tokenized once and truncated on line boundaries (prefix keeps its tail,
+    suffix its head); the context is cut at symbol/hit boundaries.
+    """
+    budget = max(0, budget - 3)  # FIM markers
+
+    blocks = tokenize_context_blocks(context_symbols, context_hits)
+    ctx_ids = fit_context_ids(blocks)
+    pre_ids, pre_offs = tokenize_with_offsets(prefix or "")
+    suf_ids, suf_offs = tokenize_with_offsets(suffix or "")
+
+    context_b, prefix_b, suffix_b = allocate_fim_budget(len(ctx_ids), len(pre_ids), len(suf_ids), budget)
+
+    if context_b < len(ctx_ids):
+        ctx_ids = fit_context_ids(blocks, context_b)
+        # hand what the dropped items leave unused back to prefix and suffix
+        _, prefix_b, suffix_b = allocate_fim_budget(len(ctx_ids), len(pre_ids), len(suf_ids), budget)
+
+    pre_ids = keep_tail_tokens(prefix, pre_ids, pre_offs, prefix_b)
+    suf_ids = keep_head_tokens(suffix, suf_ids, suf_offs, suffix_b)
+
+    return [FIM_PREFIX_ID] + ctx_ids + pre_ids + [FIM_SUFFIX_ID] + suf_ids + [FIM_MIDDLE_ID]
+
+
+def rag_context_items(hits: List[dict]) -> List[str]:
+    return [text for text in ((h.get("text") or "").strip() for h in hits) if text]
+
+
+def symbol_context_items(symbols: List[dict]) -> List[str]:
     items = []
-    for h in hits:
-        text = (h.get("text") or "").strip()
-        if not text:
+    for sym in symbols:
+        sig = (sym.get("signature") or "").strip()
+        if not sig:
             continue
-        items.append(text)
+        lines = [f"# {sym.get('file_path')}:{sym.get('line')} ({sym.get('qualname')})", sig]
+        doc = (sym.get("doc") or "").strip()
+        if doc:
+            lines.extend(f"    # {d}" for d in doc.splitlines())
+        items.append("\n".join(lines))
+    return items
+
+
+def build_rag_context_block(hits: List[dict]) -> str:
+    items = rag_context_items(hits)
+    return RAG_CONTEXT_HEADER + CONTEXT_SEP.join(items) + CONTEXT_CLOSE if items else ""
 
-    body = "\n\n".join(items).strip()
-    if not body:
-        return ""
 
-    return (
-        '"""\n'
-        "RAG_CONTEXT (internal codebase; for reference only)\n"
-        f"{body}\n"
-        '"""\n\n'
-    )
+def build_symbol_context_block(symbols: List[dict]) -> str:
+    items = symbol_context_items(symbols)
+    return SYMBOL_CONTEXT_HEADER + CONTEXT_SEP.join(items) + CONTEXT_CLOSE if items else ""
 
 
 def strip_at_stop_strings(text: str, stop_strings: List[str]) -> str:
@@ -125,7 +350,18 @@ def strip_at_stop_strings(text: str, stop_strings: List[str]) -> str:
     return text
 
 
-async def generate(
+def prefill_shared_cache(input_ids: torch.LongTensor, n: int) -> DynamicCache:
+    """
+    Run the prompt (minus its last token) through the model once and repeat
+    the KV cache `n` times, so `n` sampled rows share a single prefill.
+    """
+    cache = DynamicCache()
+    model(input_ids=input_ids[:, :-1], past_key_values=cache, use_cache=True)
+    cache.batch_repeat_interleave(n)
+    return cache
+
+
+def generate_sync(
         prefix: str,
         suffix: str,
         max_new_tokens: int = 256,
@@ -133,43 +369,108 @@ async def generate(
         top_p: float = 0.95,
         do_sample: bool = True,
         stop: Optional[List[str]] = None,
-):
-    prompt = build_fim_prompt(prefix, suffix)
-    stop_strings = DEFAULT_STOP_STRINGS + stop
+        context_symbols: Optional[List[dict]] = None,
+        context_hits: Optional[List[dict]] = None,
+        prompt_token_budget: Optional[int] = None,
+        mode: str = "auto",
+        n: int = 1,
+        language: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Returns (candidates, mode). Candidates are deduplicated and sorted by mean
+    token log-prob, best first. n > 1 always samples.
+    """
+    stop_strings = DEFAULT_STOP_STRINGS + (stop or [])
+
+    budget = prompt_token_budget or PROMPT_TOKEN_BUDGET
+    max_positions = getattr(model.config, "max_position_embeddings", None)
+    if max_positions:
+        budget = min(budget, max_positions - max_new_tokens)
+
+    with record_function("copilot.tokenize"):
+        prompt_ids = build_fim_input_ids(prefix, suffix, context_symbols=context_symbols,
+                                         context_hits=context_hits, budget=budget)
+    input_ids = torch.tensor([prompt_ids], dtype=torch.long, device=device)
+    prompt_len = input_ids.shape[1]
+
+    if n > 1 and not do_sample:
+        # identical greedy rows would all dedupe into one candidate
+        do_sample = True
+        temperature = temperature if temperature > 0.0 else 0.7
 
-    inputs = tokenizer(prompt, return_tensors="pt")
-    input_ids = inputs["input_ids"].to(device)
-    attention_mask = inputs.get("attention_mask", None)
-    if attention_mask is not None:
-        attention_mask = attention_mask.to(device)
+    stopper = CompletionStopper(prefix, suffix, mode=mode, language=language)
 
     stop_token_id_seqs = encode_stop_strings(stop_strings)
-    stopping = StoppingCriteriaList([StopOnSequences(stop_token_id_seqs)]) if stop_token_id_seqs else None
+    criteria = [StopOnStructure(stopper, prompt_len=prompt_len)]
+    if stop_token_id_seqs:
+        criteria.append(StopOnSequences(stop_token_id_seqs))
+    stopping = StoppingCriteriaList(criteria)
+    recorder = TokenLogProbRecorder(prompt_len, tokenizer.eos_token_id)
 
     with torch.inference_mode():
-        gen = model.generate(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            max_new_tokens=max_new_tokens,
-            do_sample=do_sample,
-            temperature=temperature if do_sample else None,
-            top_p=top_p if do_sample else None,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.eos_token_id,
-            stopping_criteria=stopping,
-            use_cache=True
-        )
-
-    gen_ids = gen[0]
-    new_ids = gen_ids[input_ids.shape[1]:]
-    completion = tokenizer.decode(new_ids, skip_special_tokens=True)
-
-    completion = strip_at_stop_strings(completion, stop_strings)
-
-    completion = completion.rstrip("\n\r\t ")
-
-    finish_reason = "stop"
-    if len(new_ids) >= max_new_tokens:
-        finish_reason = "length"
-
-    return completion, finish_reason
\ No newline at end of file
+        past_key_values = None
+        if n > 1:
+            with record_function("copilot.shared_prefill"):
+                past_key_values = prefill_shared_cache(input_ids, n)
+            input_ids = input_ids.repeat(n, 1)
+
+        with record_function("copilot.generate"):
+            gen = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                do_sample=do_sample,
+                temperature=temperature if do_sample else None,
+                top_p=top_p if do_sample else None,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.eos_token_id,
+                stopping_criteria=stopping,
+                logits_processor=LogitsProcessorList([recorder]),
+                use_cache=True
+            )
+
+    mean_logprobs = recorder.finalize(gen)
+
+    best: Dict[str, Dict[str, Any]] = {}
+    for row, mean_logprob in zip(gen, mean_logprobs):
+        new_ids = row[prompt_len:]
+        eos_hits = (new_ids == tokenizer.eos_token_id).nonzero()
+        n_new = int(eos_hits[0]) if len(eos_hits) else len(new_ids)
+        completion = tokenizer.decode(new_ids[:n_new], skip_special_tokens=True)
+
+        completion = strip_at_stop_strings(completion, stop_strings)
+        cut = stopper.find_cut(completion)
+        if cut is not None:
+            completion = completion[:cut]
+
+        completion = completion.rstrip("\n\r\t ")
+
+        finish_reason = "stop"
+        if cut is None and n_new >= max_new_tokens:
+            finish_reason = "length"
+
+        prev = best.get(completion)
+        if prev is None or mean_logprob > prev["mean_logprob"]:
+            best[completion] = {
+                "completion": completion,
+                "finish_reason": finish_reason,
+                "mean_logprob": float(mean_logprob),
+            }
+
+    candidates = sorted(best.values(), key=lambda c: c["mean_logprob"], reverse=True)
+    # an empty suggestion is only useful when nothing else came back
+    non_empty = [c for c in candidates if c["completion"].strip()]
+    return (non_empty or candidates[:1]), stopper.mode
+
+
+async def generate(*args, profiler=None, **kwargs) -> Tuple[List[Dict[str, Any]], str]:
+    # run the blocking decode off the event loop so the server keeps admitting/rejecting requests;
+    # the profiler context is entered on the same thread that runs the model
+    def run():
+        if profiler is None:
+            return generate_sync(*args, **kwargs)
+        with profiler.profile_request():
+            return generate_sync(*args, **kwargs)
+
+    return await asyncio.to_thread(run)
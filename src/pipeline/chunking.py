@@ -3,12 +3,14 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 import hashlib
 
 
+CODE_SEPARATORS = [
+    "\nclass", "\ndef", "\nasync def", "\n\n", "\n", " ", ""
+]
+
 splitter = RecursiveCharacterTextSplitter(
     chunk_size=1000,
     chunk_overlap=200,
-    separators=[
-        "\nclass", "\ndef", "\nasync def", "\n\n", "\n", " ", ""
-    ]
+    separators=CODE_SEPARATORS,
 )
 
 def read_text(path: Path) -> str:
@@ -22,8 +24,21 @@ def sha1_hex(s: str) -> str:
     return hashlib.sha1(s.encode("utf-8")).hexdigest()
 
 
+def normalize_file_path(repo_root: Path, file_path: Path) -> str:
+    p = Path(file_path)
+    if p.is_absolute():
+        try:
+            p = p.resolve().relative_to(Path(repo_root).resolve())
+        except ValueError:
+            pass
+    return p.as_posix()
+
+
 def split_code_file(repo_root: Path, file_path: Path, repo: str, commit: str):
-    text = read_text(file_path)
+    return split_code_text(read_text(file_path), normalize_file_path(repo_root, file_path), repo=repo, commit=commit)
+
+
+def split_code_text(text: str, rel_path: str, repo: str, commit: str):
     if not text.strip():
         return []
 
@@ -32,8 +47,8 @@ def split_code_file(repo_root: Path, file_path: Path, repo: str, commit: str):
         metadatas=[{
             "repo": repo,
             "commit": commit,
-            "file_path": file_path,
-            "language": file_path.suffix.lstrip(".").lower()
+            "file_path": rel_path,
+            "language": Path(rel_path).suffix.lstrip(".").lower()
         }]
     )
 
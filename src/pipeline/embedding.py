@@ -1,17 +1,28 @@
-from typing import List
+from typing import List, Optional
 from sentence_transformers import SentenceTransformer
 
+from pipeline.projection import Projection
+
 
 class Embedder:
-    def __init__(self, dim: int, model_path: str, normalize: bool = True):
-        self.dim = dim
+    def __init__(self, dim: int, model_path: str, normalize: bool = True, projection: Optional[Projection] = None):
+        self.dim = projection.out_dim if projection is not None else dim
         self.model = SentenceTransformer(model_path)
         self.normalize = normalize
+        self.projection = projection
 
-    def embed_batch(self, texts: List[str]) -> List[List[float]]:
-        vecs = self.model.encode(
+    def _encode(self, texts: List[str]):
+        return self.model.encode(
             texts,
             normalize_embeddings=self.normalize,
             show_progress_bar=True
         )
+
+    def embed_batch_full(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts).tolist()
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        vecs = self._encode(texts)
+        if self.projection is not None:
+            vecs = self.projection.apply(vecs)
         return vecs.tolist()
\ No newline at end of file
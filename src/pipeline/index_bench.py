@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import time
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+from pymilvus import (
+    FieldSchema,
+    CollectionSchema,
+    DataType,
+    Collection,
+    utility,
+)
+
+from pipeline.milvus import (
+    Milvus,
+    VECTOR_DTYPES,
+    SEARCH_EFFORT_PARAMS,
+    build_index_params,
+    build_search_params,
+    encode_vectors,
+    decode_vectors,
+)
+
+
+def load_vectors(db: Milvus, col: Collection, limit: int, batch_size: int = 1000) -> np.ndarray:
+    col.load()
+    vector_dtype = db.collection_spec(col)["vector_dtype"]
+    it = col.query_iterator(batch_size=batch_size, limit=limit, expr="", output_fields=["embedding"])
+    vecs: List[Any] = []
+    while True:
+        rows = it.next()
+        if not rows:
+            it.close()
+            break
+        vecs.extend(r["embedding"] for r in rows)
+    if not vecs:
+        raise SystemExit(f"Collection {col.name} has no vectors")
+    return decode_vectors(vecs, vector_dtype)
+
+
+def brute_force_topk(corpus: np.ndarray, queries: np.ndarray, k: int, metric: str) -> np.ndarray:
+    if metric.upper() == "L2":
+        scores = -(
+            (queries ** 2).sum(axis=1, keepdims=True)
+            - 2.0 * queries @ corpus.T
+            + (corpus ** 2).sum(axis=1)[None, :]
+        )
+    else:
+        if metric.upper() == "COSINE":
+            corpus = corpus / np.linalg.norm(corpus, axis=1, keepdims=True).clip(min=1e-12)
+            queries = queries / np.linalg.norm(queries, axis=1, keepdims=True).clip(min=1e-12)
+        scores = queries @ corpus.T
+    top = np.argpartition(-scores, kth=min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    return top
+
+
+def segment_mem_bytes(name: str) -> int:
+    return int(sum(s.mem_size for s in utility.get_query_segment_info(name)))
+
+
+def bench_config(
+        name: str,
+        corpus: np.ndarray,
+        queries: np.ndarray,
+        truth: np.ndarray,
+        index_type: str,
+        vector_dtype: str,
+        metric: str,
+        efforts: List[Optional[int]],
+        top_k: int,
+        index_params: Optional[Dict[str, Any]] = None,
+        batch_size: int = 1000,
+) -> Dict[str, Any]:
+    if utility.has_collection(name):
+        utility.drop_collection(name)
+
+    schema = CollectionSchema([
+        FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=False),
+        FieldSchema(name="embedding", dtype=VECTOR_DTYPES[vector_dtype], dim=corpus.shape[1]),
+    ], description="index benchmark scratch collection")
+    col = Collection(name, schema=schema)
+
+    try:
+        t0 = time.perf_counter()
+        for i in range(0, len(corpus), batch_size):
+            batch = corpus[i: i + batch_size]
+            col.insert([list(range(i, i + len(batch))), encode_vectors(batch.tolist(), vector_dtype)])
+        col.flush()
+        insert_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        col.create_index(field_name="embedding", index_params=build_index_params(index_type, metric, index_params))
+        utility.wait_for_index_building_complete(name)
+        build_s = time.perf_counter() - t0
+
+        col.load()
+        mem = segment_mem_bytes(name)
+
+        query_data = encode_vectors(queries.tolist(), vector_dtype)
+        runs: List[Dict[str, Any]] = []
+        for effort in efforts:
+            params = build_search_params(index_type, metric, effort, limit=top_k)
+            latencies: List[float] = []
+            recalls: List[float] = []
+            for qi, q in enumerate(query_data):
+                t0 = time.perf_counter()
+                res = col.search(data=[q], anns_field="embedding", param=params, limit=top_k)
+                latencies.append((time.perf_counter() - t0) * 1000.0)
+                got = {int(h.id) for h in res[0]}
+                recalls.append(len(got & set(truth[qi].tolist())) / float(top_k))
+
+            lat = np.asarray(latencies)
+            runs.append({
+                "search_params": params["params"],
+                f"recall@{top_k}": round(float(np.mean(recalls)), 4),
+                "latency_ms_mean": round(float(lat.mean()), 3),
+                "latency_ms_p50": round(float(np.percentile(lat, 50)), 3),
+                "latency_ms_p95": round(float(np.percentile(lat, 95)), 3),
+            })
+
+        return {
+            "index_type": index_type,
+            "vector_dtype": vector_dtype,
+            "index_params": build_index_params(index_type, metric, index_params)["params"],
+            "insert_s": round(insert_s, 3),
+            "build_s": round(build_s, 3),
+            "loaded_mem_bytes": mem,
+            "bytes_per_vector": round(mem / float(len(corpus)), 1),
+            "runs": runs,
+        }
+    finally:
+        utility.drop_collection(name)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Recall@k / latency / memory of Milvus index configs on a sample of a collection.")
+    ap.add_argument("--milvus_host", default=os.getenv("MILVUS_HOST", "127.0.0.1"))
+    ap.add_argument("--milvus_port", default=os.getenv("MILVUS_PORT", "19530"))
+    ap.add_argument("--collection", default=os.getenv("MILVUS_COLLECTION", "code_chunks"))
+    ap.add_argument("--metric", default=os.getenv("MILVUS_METRIC", "IP"))
+
+    ap.add_argument("--sample", type=int, default=20000, help="Vectors copied from the collection into each scratch index.")
+    ap.add_argument("--queries", type=int, default=200, help="Held-out vectors used as queries.")
+    ap.add_argument("--top_k", type=int, default=10)
+    ap.add_argument("--index_types", default="HNSW,IVF_FLAT,IVF_SQ8,IVF_PQ")
+    ap.add_argument("--vector_dtypes", default="FLOAT_VECTOR,FLOAT16_VECTOR")
+    ap.add_argument("--efforts", default="",
+                    help="Comma-separated search-effort values (ef / nprobe / search_list). Default: index default only.")
+    ap.add_argument("--index_params", default="", help="JSON overrides applied to every index build.")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--output", default="", help="Write the JSON report here instead of stdout.")
+    args = ap.parse_args()
+
+    db = Milvus(args.milvus_host, args.milvus_port)
+    if not utility.has_collection(args.collection):
+        raise SystemExit(f"Collection {args.collection} not found")
+    src = Collection(args.collection)
+
+    vecs = load_vectors(db, src, limit=args.sample + args.queries)
+    rng = np.random.default_rng(args.seed)
+    rng.shuffle(vecs)
+    n_queries = min(args.queries, max(1, len(vecs) // 10))
+    queries, corpus = vecs[:n_queries], vecs[n_queries:]
+    top_k = min(args.top_k, len(corpus))
+
+    truth = brute_force_topk(corpus, queries, top_k, args.metric)
+    efforts: List[Optional[int]] = [int(x) for x in args.efforts.split(",") if x.strip()] or [None]
+    index_params = json.loads(args.index_params) if args.index_params.strip() else None
+
+    results: List[Dict[str, Any]] = []
+    for vector_dtype in [x.strip().upper() for x in args.vector_dtypes.split(",") if x.strip()]:
+        for index_type in [x.strip().upper() for x in args.index_types.split(",") if x.strip()]:
+            if index_type not in SEARCH_EFFORT_PARAMS:
+                raise SystemExit(f"Unsupported index_type={index_type}")
+            print(f"[bench] {index_type} / {vector_dtype} ...", flush=True)
+            results.append(bench_config(
+                name=f"{args.collection}_index_bench",
+                corpus=corpus,
+                queries=queries,
+                truth=truth,
+                index_type=index_type,
+                vector_dtype=vector_dtype,
+                metric=args.metric,
+                efforts=efforts,
+                top_k=top_k,
+                index_params=index_params,
+            ))
+
+    report = {
+        "collection": args.collection,
+        "metric": args.metric.upper(),
+        "dim": int(corpus.shape[1]),
+        "corpus_size": int(len(corpus)),
+        "queries": int(len(queries)),
+        "top_k": top_k,
+        "float32_raw_bytes": int(corpus.nbytes),
+        "results": results,
+    }
+
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(out)
+    print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,446 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+from pipeline.chunking import split_code_file
+from pipeline.milvus import Milvus, build_schema, build_index_params
+from pipeline.pipeline_ingest import ingest_files, iter_repo_files
+
+
+SEED_DIR = Path(__file__).resolve().parent.parent / "code"
+
+LANGUAGE_EXTS = {"py": ".py", "js": ".js", "ts": ".ts", "go": ".go", "java": ".java", "rs": ".rs"}
+
+_EXPR_CLAUSE = re.compile(r"^\s*(\w+)\s*(==|!=|in)\s*(.+?)\s*$")
+
+
+class LocalCollection:
+    """
+    In-memory stand-in for the subset of pymilvus.Collection that the ingest
+    path uses (upsert / delete / query_iterator / flush / partitions), so the
+    benchmark measures our code rather than a Milvus server. Filter expressions
+    are limited to `field == v`, `field != v` and `field in [...]` joined by `&&`.
+    """
+    def __init__(self, name: str, schema, index_type: str = "HNSW", metric: str = "IP"):
+        self.name = name
+        self.schema = schema
+        self.indexes = [SimpleNamespace(field_name="embedding", params=build_index_params(index_type, metric))]
+        self._partitions: Dict[str, Dict[str, Dict[str, Any]]] = {"_default": {}}
+
+    @property
+    def num_entities(self) -> int:
+        return sum(len(rows) for rows in self._partitions.values())
+
+    def load(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def has_partition(self, name: str) -> bool:
+        return name in self._partitions
+
+    def create_partition(self, name: str) -> None:
+        self._partitions.setdefault(name, {})
+
+    def _targets(self, partition_names: Optional[List[str]]) -> List[Dict[str, Dict[str, Any]]]:
+        if not partition_names:
+            return list(self._partitions.values())
+        return [self._partitions[p] for p in partition_names if p in self._partitions]
+
+    def upsert(self, rows: List[Dict[str, Any]], partition_name: Optional[str] = None) -> None:
+        target = self._partitions[partition_name or "_default"]
+        for part in self._partitions.values():
+            if part is not target:
+                for r in rows:
+                    part.pop(r["pk"], None)
+        for r in rows:
+            target[r["pk"]] = dict(r)
+
+    def insert(self, rows: List[Dict[str, Any]], partition_name: Optional[str] = None) -> None:
+        self.upsert(rows, partition_name=partition_name)
+
+    def delete(self, expr: str, partition_name: Optional[str] = None) -> None:
+        match = _compile_expr(expr)
+        for part in self._targets([partition_name] if partition_name else None):
+            for pk in [pk for pk, r in part.items() if match(r)]:
+                del part[pk]
+
+    def query(self, expr: str = "", output_fields: Optional[List[str]] = None,
+              partition_names: Optional[List[str]] = None, **kwargs) -> List[Dict[str, Any]]:
+        return self.query_iterator(expr=expr, output_fields=output_fields, partition_names=partition_names)._rows
+
+    def query_iterator(self, batch_size: int = 1000, limit: int = -1, expr: str = "",
+                       output_fields: Optional[List[str]] = None, partition_names: Optional[List[str]] = None,
+                       **kwargs):
+        match = _compile_expr(expr)
+        fields = output_fields or ["pk"]
+        rows = [
+            {f: r.get(f) for f in fields}
+            for part in self._targets(partition_names)
+            for r in part.values()
+            if match(r)
+        ]
+        if limit is not None and limit >= 0:
+            rows = rows[:limit]
+        return _LocalIterator(rows, batch_size)
+
+
+class _LocalIterator:
+    def __init__(self, rows: List[Dict[str, Any]], batch_size: int):
+        self._rows = rows
+        self._batch_size = batch_size
+        self._pos = 0
+
+    def next(self) -> List[Dict[str, Any]]:
+        batch = self._rows[self._pos: self._pos + self._batch_size]
+        self._pos += len(batch)
+        return batch
+
+    def close(self) -> None:
+        self._rows = []
+
+
+def _compile_expr(expr: str):
+    if not expr or not expr.strip():
+        return lambda row: True
+
+    clauses: List[Tuple[str, str, Any]] = []
+    for part in expr.split("&&"):
+        m = _EXPR_CLAUSE.match(part)
+        if not m:
+            raise ValueError(f"LocalCollection cannot evaluate expression clause: {part.strip()!r}")
+        field, op, raw = m.groups()
+        value = json.loads(raw)
+        clauses.append((field, op, set(value) if op == "in" else value))
+
+    def match(row: Dict[str, Any]) -> bool:
+        for field, op, value in clauses:
+            v = row.get(field)
+            if op == "==" and v != value:
+                return False
+            if op == "!=" and v == value:
+                return False
+            if op == "in" and v not in value:
+                return False
+        return True
+
+    return match
+
+
+class HashEmbedder:
+    """
+    Deterministic, model-free embedder (hashed token counts, L2-normalised).
+    Isolates chunking / storage cost from model inference.
+    """
+    def __init__(self, dim: int = 768):
+        self.dim = dim
+        self.projection = None
+
+    def embed_batch_full(self, texts: List[str]) -> List[List[float]]:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, t in enumerate(texts):
+            for tok in re.findall(r"\w+", t):
+                h = int.from_bytes(hashlib.blake2b(tok.encode("utf-8"), digest_size=8).digest(), "little")
+                out[i, h % self.dim] += 1.0 if (h >> 63) else -1.0
+        out /= np.linalg.norm(out, axis=1, keepdims=True).clip(min=1e-12)
+        return out.tolist()
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_batch_full(texts)
+
+
+class TimedEmbedder:
+    """Wraps an embedder and accumulates the time spent inside embed_batch."""
+    def __init__(self, inner):
+        self.inner = inner
+        self.dim = inner.dim
+        self.projection = inner.projection
+        self.seconds = 0.0
+        self.texts = 0
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        t0 = time.perf_counter()
+        vecs = self.inner.embed_batch(texts)
+        self.seconds += time.perf_counter() - t0
+        self.texts += len(texts)
+        return vecs
+
+    def embed_batch_full(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_batch_full(texts)
+
+
+# ---------- synthetic repositories ----------
+
+def load_seeds(seed_dir: Path = SEED_DIR) -> List[str]:
+    seeds = [p.read_text(encoding="utf-8") for p in sorted(seed_dir.glob("*.py"))]
+    if not seeds:
+        raise SystemExit(f"No seed files found in {seed_dir}")
+    return seeds
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """'py:0.6,js:0.2,go:0.2' -> normalised weights."""
+    out: Dict[str, float] = {}
+    for item in (mix or "py:1").split(","):
+        if not item.strip():
+            continue
+        lang, _, w = item.partition(":")
+        lang = lang.strip().lower()
+        if lang not in LANGUAGE_EXTS:
+            raise SystemExit(f"Unsupported language={lang}. Choose from {sorted(LANGUAGE_EXTS)}")
+        out[lang] = float(w or 1.0)
+    total = sum(out.values())
+    if total <= 0:
+        raise SystemExit(f"Language mix {mix!r} has no positive weight")
+    return {k: v / total for k, v in out.items()}
+
+
+def _rename_defs(seed: str, tag: str) -> str:
+    names = set(re.findall(r"^\s*(?:def|class)\s+(\w+)", seed, flags=re.M)) - {"__init__"}
+    for name in sorted(names, key=len, reverse=True):
+        seed = re.sub(rf"\b{re.escape(name)}\b", f"{name}_{tag}", seed)
+    return seed
+
+
+def _python_functions(seed: str) -> List[Tuple[str, List[str], List[str]]]:
+    """(name, params, body lines) of every `def` in a seed file."""
+    funcs: List[Tuple[str, List[str], List[str]]] = []
+    for block in re.split(r"\n(?=\s*def )", seed):
+        m = re.match(r"\s*def\s+(\w+)\s*\(([^)]*)\)", block)
+        if m:
+            params = [a.split("=")[0].split(":")[0].strip().lstrip("*") for a in m.group(2).split(",")]
+            body = [ln.strip() for ln in block.split("\n")[1:] if ln.strip()]
+            funcs.append((m.group(1), [p for p in params if p and p != "self"], body))
+    return funcs
+
+
+def _translate(seed: str, lang: str) -> str:
+    # Same identifiers and roughly the same text volume as the seed, in the
+    # target language's shape; the original body is kept as comments.
+    lines: List[str] = []
+    if lang == "go":
+        lines.append("package synthetic\n")
+    elif lang == "java":
+        lines.append("public class Synthetic {")
+    for name, params, body in _python_functions(seed) or [("main", [], seed.split("\n"))]:
+        comments = [f"    // {b}" for b in body]
+        if lang in {"js", "ts"}:
+            sig = ", ".join(f"{p}: any" if lang == "ts" else p for p in params)
+            lines += [f"export function {name}({sig}) {{", *comments, "  return null;", "}", ""]
+        elif lang == "go":
+            lines += [f"func {name}({', '.join(f'{p} int' for p in params)}) int {{", *comments, "\treturn 0", "}", ""]
+        elif lang == "java":
+            sig = ", ".join(f"Object {p}" for p in params)
+            lines += [f"  public static Object {name}({sig}) {{", *comments, "    return null;", "  }", ""]
+        elif lang == "rs":
+            sig = ", ".join(f"{p}: i64" for p in params)
+            lines += [f"pub fn {name}({sig}) -> i64 {{", *comments, "    0", "}", ""]
+    if lang == "java":
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def generate_repo(root: Path, files: int, mix: Dict[str, float], seeds: List[str],
+                  copies_per_file: int = 1, files_per_dir: int = 50, seed: int = 0) -> List[Path]:
+    """
+    Write `files` source files under `root/src/`, each built from
+    `copies_per_file` seed files with renamed definitions, so chunk hashes
+    stay unique across the repo. Returns the file paths.
+    """
+    rng = random.Random(seed)
+    langs = list(mix)
+    weights = [mix[k] for k in langs]
+    out: List[Path] = []
+    for i in range(files):
+        lang = rng.choices(langs, weights=weights)[0]
+        parts = [_rename_defs(rng.choice(seeds), f"{i}_{j}") for j in range(copies_per_file)]
+        text = "\n\n".join(parts) if lang == "py" else "\n".join(_translate(p, lang) for p in parts)
+
+        d = root / "src" / f"pkg_{i // files_per_dir:04d}"
+        d.mkdir(parents=True, exist_ok=True)
+        p = d / f"mod_{i:06d}{LANGUAGE_EXTS[lang]}"
+        p.write_text(text, encoding="utf-8")
+        out.append(p)
+    return out
+
+
+# ---------- measurement ----------
+
+def reset_peak_rss() -> bool:
+    # Linux only: "5" resets the VmHWM high-water mark of this process.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss: KiB on Linux, bytes on macOS; process lifetime peak
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == "Darwin" else rss * 1024
+
+
+class Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.result: Dict[str, Any] = {}
+
+    def __enter__(self) -> "Stage":
+        self.per_stage_peak = reset_peak_rss()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.seconds = time.perf_counter() - self.t0
+        self.result = {
+            "seconds": round(self.seconds, 4),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "peak_rss_scope": "stage" if self.per_stage_peak else "process",
+        }
+
+    def rate(self, key: str, count: int) -> None:
+        self.result[key] = round(count / self.seconds, 2) if self.seconds > 0 else None
+
+
+def new_collection(name: str, dim: int, layout: str) -> LocalCollection:
+    return LocalCollection(name, build_schema(dim, layout=layout))
+
+
+def bench(
+        repo_root: Path,
+        files: List[Path],
+        embedder,
+        batch_sizes: List[int],
+        layout: str = "flat",
+        repo: str = "bench",
+        branch: str = "main",
+) -> Dict[str, Any]:
+    db = Milvus(host=None)
+    stages: Dict[str, Any] = {}
+
+    with Stage("chunk") as st:
+        chunks: List[Dict[str, Any]] = []
+        for fp in files:
+            for c in split_code_file(repo_root, fp, repo=repo, commit="bench"):
+                c["branch"] = branch
+                chunks.append(c)
+    st.rate("files_per_s", len(files))
+    st.rate("chunks_per_s", len(chunks))
+    stages["chunk"] = {**st.result, "files": len(files), "chunks": len(chunks)}
+
+    texts = [c["text"] for c in chunks]
+    stages["embed"] = []
+    stages["upsert"] = []
+    for bs in batch_sizes:
+        with Stage("embed") as st:
+            for i in range(0, len(texts), bs):
+                embedder.embed_batch(texts[i: i + bs])
+        st.rate("embeddings_per_s", len(texts))
+        stages["embed"].append({"batch_size": bs, **st.result})
+
+        col = new_collection(f"bench_upsert_{bs}", embedder.dim, layout)
+        timed = TimedEmbedder(embedder)
+        with Stage("upsert") as st:
+            db.upsert_chunks(col, chunks, embedder=timed, batch_size=bs)
+        st.rate("chunks_per_s", len(chunks))
+        store_s = st.seconds - timed.seconds
+        stages["upsert"].append({
+            "batch_size": bs,
+            **st.result,
+            "embed_seconds": round(timed.seconds, 4),
+            "store_chunks_per_s": round(len(chunks) / store_s, 2) if store_s > 0 else None,
+            "rows": col.num_entities,
+        })
+
+    bs = batch_sizes[-1]
+    col = new_collection("bench_e2e", embedder.dim, layout)
+    for run in ("initial", "unchanged"):
+        # the second run re-ingests identical files: the sync cost with nothing new
+        with Stage("e2e") as st:
+            stats = ingest_files(db, col, repo_root=repo_root, targets=files, repo=repo, branch=branch,
+                                 commit="bench", embedder=embedder, batch_size=bs)
+        st.rate("files_per_s", stats["files"])
+        st.rate("chunks_per_s", stats["chunks"])
+        stages[f"e2e_{run}"] = {"batch_size": bs, **st.result, **stats, "rows": col.num_entities}
+
+    return stages
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Throughput of the ingest stages (chunk / embed / upsert / end-to-end) on synthetic repos.")
+    ap.add_argument("--files", type=int, default=500, help="Files in the synthetic repo.")
+    ap.add_argument("--mix", default="py:0.6,ts:0.15,go:0.1,java:0.1,rs:0.05",
+                    help="Language mix as lang:weight pairs; languages: " + ",".join(sorted(LANGUAGE_EXTS)))
+    ap.add_argument("--copies_per_file", type=int, default=2, help="Seed files concatenated per synthetic file (file size).")
+    ap.add_argument("--seed_dir", default=str(SEED_DIR))
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repo_dir", default="", help="Keep the synthetic repo here instead of a temp dir.")
+    ap.add_argument("--batch_sizes", default="32,128", help="Comma-separated embed/upsert batch sizes to compare.")
+    ap.add_argument("--layout", default="flat", help="flat | partition_key | partition_per_repo")
+    ap.add_argument("--embed_model", default="",
+                    help="SentenceTransformer model for the embed stages. Default: model-free hash embedder.")
+    ap.add_argument("--embed_dim", type=int, default=int(os.getenv("EMBED_DIM", "768")))
+    ap.add_argument("--output", default="", help="Write the JSON report here instead of stdout.")
+    args = ap.parse_args()
+
+    if args.embed_model:
+        from pipeline.embedding import Embedder
+        embedder = Embedder(dim=args.embed_dim, model_path=args.embed_model, normalize=True)
+    else:
+        embedder = HashEmbedder(dim=args.embed_dim)
+
+    mix = parse_mix(args.mix)
+    batch_sizes = [int(x) for x in args.batch_sizes.split(",") if x.strip()] or [128]
+
+    with tempfile.TemporaryDirectory(prefix="ingest_bench_") as tmp:
+        repo_root = Path(args.repo_dir or tmp).resolve()
+        t0 = time.perf_counter()
+        generate_repo(repo_root, args.files, mix, load_seeds(Path(args.seed_dir)),
+                      copies_per_file=args.copies_per_file, seed=args.seed)
+        gen_s = time.perf_counter() - t0
+
+        files = iter_repo_files(repo_root, [repo_root / "src"])
+        stages = bench(repo_root, files, embedder, batch_sizes, layout=args.layout)
+
+        report = {
+            "files": len(files),
+            "bytes": sum(p.stat().st_size for p in files),
+            "mix": mix,
+            "copies_per_file": args.copies_per_file,
+            "embedder": args.embed_model or "hash",
+            "dim": embedder.dim,
+            "layout": args.layout,
+            "generate_s": round(gen_s, 3),
+            "stages": stages,
+        }
+
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(out)
+    print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,60 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
 from transformers import AutoTokenizer
-from datasets import load_dataset
+from datasets import Dataset, IterableDataset, load_dataset, load_from_disk
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer
 
 from tqdm.auto import tqdm
-from uuid import uuid4
 
 from dotenv import load_dotenv
 
+from pipeline.chunking import CODE_SEPARATORS, splitter as default_splitter, sha1_hex
 from pipeline.embedding import Embedder
+from pipeline.milvus import Milvus
+from pipeline.projection import load_projection
 
 load_dotenv()
 
+
+# Candidate dataset columns per chunk field, first match wins (code_search_net names first).
+COLUMN_CANDIDATES: Dict[str, List[str]] = {
+    "text": ["whole_func_string", "func_code_string", "code", "content", "text"],
+    "repo": ["repository_name", "repo_name", "repo"],
+    "file_path": ["func_path_in_repository", "path", "file_path"],
+    "language": ["language", "lang"],
+}
+
+
+def open_dataset(name: str, config: Optional[str] = None, split: str = "train", streaming: bool = False):
+    """
+    Dataset without loading it into memory: a `save_to_disk` directory or an
+    .arrow file is memory-mapped, a hub/script name is Arrow-cached or, with
+    `streaming`, read lazily as an IterableDataset.
+    """
+    if os.path.isdir(name) and os.path.exists(os.path.join(name, "state.json")):
+        return load_from_disk(name)
+    if name.endswith(".arrow") and os.path.isfile(name):
+        return Dataset.from_file(name)
+    return load_dataset(name, config, split=split, streaming=streaming)
+
+
 class CodeIngestion:
+    """
+    Bulk loader from a Hugging Face dataset of code snippets into the chunk
+    collection: rows are read in column batches, split, embedded and upserted
+    `batch_limit` chunks at a time, so memory stays bounded by one batch
+    whatever the dataset size.
+
+    Progress is checkpointed as the number of source rows whose chunks are all
+    written; a rerun with the same checkpoint file continues from there. pks are
+    deterministic, so rows replayed after a crash are upserted, not duplicated.
+    """
     def __init__(
             self,
             collection,
@@ -21,7 +62,224 @@ class CodeIngestion:
             embedder: Embedder = None,
             tokenizer: AutoTokenizer = None,
             text_splitter = None,
-            batch_limit: int = 100
+            batch_limit: int = 100,
+            repo: str = "",
+            columns: Optional[Dict[str, str]] = None,
+            checkpoint_path: Optional[str] = None,
+            checkpoint_every: int = 10,
+            read_batch_size: int = 1000,
+            max_chunk_tokens: int = 512,
+            db: Optional[Milvus] = None,
     ):
         self.collection = collection
-        self.code = code
\ No newline at end of file
+        self.code = code
+        self.embedder = embedder
+        self.batch_limit = batch_limit
+        self.repo = repo
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.read_batch_size = read_batch_size
+
+        if text_splitter is None and tokenizer is not None:
+            # size chunks in embedder tokens rather than characters
+            text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                tokenizer,
+                chunk_size=max_chunk_tokens,
+                chunk_overlap=max_chunk_tokens // 8,
+                separators=CODE_SEPARATORS,
+            )
+        self.text_splitter = text_splitter or default_splitter
+
+        self.columns = self._resolve_columns(columns or {})
+        # the collection was opened through an existing connection
+        self.db = db or Milvus(host=None)
+
+    def _resolve_columns(self, overrides: Dict[str, str]) -> Dict[str, str]:
+        names = list(self.code.column_names or []) if self.code is not None else []
+        out: Dict[str, str] = {}
+        for field, candidates in COLUMN_CANDIDATES.items():
+            col = overrides.get(field) or next((c for c in candidates if c in names), None)
+            if col is not None:
+                out[field] = col
+        if "text" not in out:
+            raise ValueError(f"No code column found in {names}; pass columns={{'text': ...}}")
+        return out
+
+    def load_checkpoint(self) -> Dict[str, Any]:
+        state = {"rows_done": 0, "chunks": 0}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("columns") != self.columns:
+                raise ValueError(f"Checkpoint {self.checkpoint_path} was written for columns {saved.get('columns')}")
+            state.update(saved)
+        return state
+
+    def save_checkpoint(self, rows_done: int, chunks: int) -> None:
+        if not self.checkpoint_path:
+            return
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "rows_done": rows_done,
+                "chunks": chunks,
+                "columns": self.columns,
+                "collection": self.collection.name,
+                "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def iter_rows(self, start: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        cols = sorted(set(self.columns.values()))
+        if isinstance(self.code, IterableDataset):
+            ds = self.code.select_columns(cols)
+            batches = ds.skip(start).iter(batch_size=self.read_batch_size)
+        else:
+            # slicing an Arrow-backed Dataset only converts that slice to Python
+            ds = self.code.select_columns(cols)
+            batches = (ds[i: i + self.read_batch_size] for i in range(start, len(ds), self.read_batch_size))
+
+        idx = start
+        for batch in batches:
+            for j in range(len(batch[cols[0]])):
+                yield idx, {c: batch[c][j] for c in cols}
+                idx += 1
+
+    def chunk_row(self, row: Dict[str, Any]) -> List[Dict[str, Any]]:
+        text = row[self.columns["text"]] or ""
+        if not text.strip():
+            return []
+        repo = str(row.get(self.columns.get("repo", ""), "") or self.repo)[:128]
+        file_path = str(row.get(self.columns.get("file_path", ""), "") or "")[:512]
+        language = str(row.get(self.columns.get("language", ""), "") or "").lower()[:32]
+
+        out: List[Dict[str, Any]] = []
+        for i, chunk_text in enumerate(self.text_splitter.split_text(text)):
+            chunk_hash = sha1_hex(f"{repo}|{file_path}|{i}|{chunk_text}")
+            out.append({
+                "pk": chunk_hash,
+                "text": chunk_text,
+                "repo": repo,
+                "commit": "",
+                "file_path": file_path,
+                "language": language,
+                "chunk_index": i,
+                "chunk_hash": chunk_hash,
+            })
+        return out
+
+    def _write(self, chunks: List[Dict[str, Any]]) -> None:
+        self.db.upsert_chunks(self.collection, chunks, embedder=self.embedder,
+                              batch_size=len(chunks), flush=False)
+
+    def run(self, max_rows: Optional[int] = None) -> Dict[str, int]:
+        state = self.load_checkpoint()
+        start, total_chunks = int(state["rows_done"]), int(state["chunks"])
+        stop = start + max_rows if max_rows else None
+
+        buffer: List[Dict[str, Any]] = []
+        owners: Deque[int] = deque()  # source row of each buffered chunk
+        rows_done, batches = start, 0
+
+        total = len(self.code) if isinstance(self.code, Dataset) else None
+        bar = tqdm(total=total, initial=start, unit="rows", desc="ingest")
+        for idx, row in self.iter_rows(start):
+            if stop is not None and idx >= stop:
+                break
+            for c in self.chunk_row(row):
+                buffer.append(c)
+                owners.append(idx)
+            rows_done = idx + 1
+            bar.update(1)
+
+            while len(buffer) >= self.batch_limit:
+                self._write(buffer[: self.batch_limit])
+                del buffer[: self.batch_limit]
+                for _ in range(self.batch_limit):
+                    owners.popleft()
+                total_chunks += self.batch_limit
+                batches += 1
+                if batches % self.checkpoint_every == 0:
+                    # rows with chunks still buffered are not done yet
+                    self.save_checkpoint(owners[0] if owners else rows_done, total_chunks)
+
+        if buffer:
+            self._write(buffer)
+            total_chunks += len(buffer)
+        bar.close()
+
+        self.collection.flush()
+        self.save_checkpoint(rows_done, total_chunks)
+        return {"rows_done": rows_done, "rows_this_run": rows_done - start, "chunks": total_chunks}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Stream a Hugging Face code dataset into the Milvus chunk collection.")
+    ap.add_argument("--dataset", required=True, help="Hub name, save_to_disk directory or .arrow file.")
+    ap.add_argument("--config", default=None)
+    ap.add_argument("--split", default="train")
+    ap.add_argument("--streaming", action="store_true", help="Read lazily instead of downloading the full split.")
+    ap.add_argument("--repo", default="", help="Repo value for rows without a repo column.")
+    ap.add_argument("--text_column", default="")
+    ap.add_argument("--repo_column", default="")
+    ap.add_argument("--path_column", default="")
+    ap.add_argument("--language_column", default="")
+    ap.add_argument("--max_rows", type=int, default=0, help="Stop after this many rows in this run (0 = all).")
+    ap.add_argument("--checkpoint", default="", help="JSON progress file; reruns resume from it.")
+
+    ap.add_argument("--milvus_host", default=os.getenv("MILVUS_HOST", "127.0.0.1"))
+    ap.add_argument("--milvus_port", default=os.getenv("MILVUS_PORT", "19530"))
+    ap.add_argument("--collection", default=os.getenv("MILVUS_COLLECTION", "code_chunks"))
+    ap.add_argument("--metric", default=os.getenv("MILVUS_METRIC", "IP"))
+    ap.add_argument("--index_type", default=os.getenv("MILVUS_INDEX_TYPE", "HNSW"))
+    ap.add_argument("--vector_dtype", default=os.getenv("MILVUS_VECTOR_DTYPE", "FLOAT_VECTOR"))
+
+    ap.add_argument("--embed_model", default=os.getenv("EMBED_MODEL", "krlvi/sentence-t5-base-nlpl-code_search_net"))
+    ap.add_argument("--embed_dim", type=int, default=int(os.getenv("EMBED_DIM", "768")))
+    ap.add_argument("--rerank_store", action="store_true", default=os.getenv("RAG_RERANK_STORE", "0") == "1",
+                    help="With a projection, also write full-dim vectors for reranking (same setting as the service).")
+    ap.add_argument("--batch_limit", type=int, default=128, help="Chunks per embed + upsert batch.")
+    ap.add_argument("--token_chunks", action="store_true",
+                    help="Size chunks with the embedding model's tokenizer instead of characters.")
+    args = ap.parse_args()
+
+    db = Milvus(args.milvus_host, args.milvus_port)
+    embedder = Embedder(dim=args.embed_dim, model_path=args.embed_model, normalize=True,
+                        projection=load_projection(args.collection))
+    col = db.ensure_collection(
+        args.collection,
+        dim=embedder.dim,
+        metric=args.metric,
+        index_type=args.index_type,
+        vector_dtype=args.vector_dtype,
+    )
+    if args.rerank_store and embedder.projection is not None:
+        db.ensure_full_vectors(col, dim=embedder.projection.in_dim)
+
+    columns = {
+        field: value for field, value in {
+            "text": args.text_column,
+            "repo": args.repo_column,
+            "file_path": args.path_column,
+            "language": args.language_column,
+        }.items() if value
+    }
+
+    ingestion = CodeIngestion(
+        col,
+        code=open_dataset(args.dataset, args.config, split=args.split, streaming=args.streaming),
+        embedder=embedder,
+        tokenizer=AutoTokenizer.from_pretrained(args.embed_model) if args.token_chunks else None,
+        batch_limit=args.batch_limit,
+        repo=args.repo or args.dataset,
+        columns=columns,
+        checkpoint_path=args.checkpoint or None,
+        db=db,
+    )
+    stats = ingestion.run(max_rows=args.max_rows or None)
+    print(f"Done. dataset={args.dataset} rows={stats['rows_done']} (+{stats['rows_this_run']}) "
+          f"chunks={stats['chunks']} collection={args.collection}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,46 +3,251 @@ from pymilvus import (
     CollectionSchema,
     DataType,
     Collection,
+    MilvusException,
     utility, connections
 )
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Iterable, Set
+import hashlib
+import json
+import re
+import time
+
+import numpy as np
 
 from pipeline.embedding import Embedder
 
 
-class Milvus:
-    def __init__(self, host: str = "127.0.0.1", port: int = 19530) -> None:
-        connections.connect(alias="default", host=host, port=port)
+# Default build params per index type. IVF_PQ's `m` must divide the vector dim.
+INDEX_PRESETS: Dict[str, Dict[str, Any]] = {
+    "HNSW": {"M": 16, "efConstruction": 200},
+    "IVF_FLAT": {"nlist": 1024},
+    "IVF_SQ8": {"nlist": 1024},
+    "IVF_PQ": {"nlist": 1024, "m": 16, "nbits": 8},
+    "DISKANN": {},
+}
 
-    def ensure_collection(self, name: str, dim: int, metric: str = "IP") -> Collection:
-        if utility.has_collection(name):
-            return Collection(name)
+# Search-effort knob per index type and its default value.
+SEARCH_EFFORT_PARAMS: Dict[str, tuple] = {
+    "HNSW": ("ef", 128),
+    "IVF_FLAT": ("nprobe", 16),
+    "IVF_SQ8": ("nprobe", 16),
+    "IVF_PQ": ("nprobe", 16),
+    "DISKANN": ("search_list", 100),
+}
+
+VECTOR_DTYPES: Dict[str, DataType] = {
+    "FLOAT_VECTOR": DataType.FLOAT_VECTOR,
+    "FLOAT16_VECTOR": DataType.FLOAT16_VECTOR,
+    "BFLOAT16_VECTOR": DataType.BFLOAT16_VECTOR,
+}
+
+
+LAYOUTS = {"flat", "partition_key", "partition_per_repo"}
+
+
+def repo_partition_name(repo: str) -> str:
+    # Partition names allow [A-Za-z0-9_] only; the hash keeps sanitized names unique.
+    safe = re.sub(r"[^0-9A-Za-z_]", "_", repo)[:64]
+    return f"repo_{safe}_{hashlib.sha1(repo.encode('utf-8')).hexdigest()[:8]}"
+
+
+def full_vectors_collection_name(collection: str) -> str:
+    return f"{collection}_full"
+
+
+def overlay_collection_name(collection: str) -> str:
+    return f"{collection}_overlay"
+
+
+def overlay_partition_name(user: str) -> str:
+    safe = re.sub(r"[^0-9A-Za-z_]", "_", user)[:64]
+    return f"user_{safe}_{hashlib.sha1(user.encode('utf-8')).hexdigest()[:8]}"
+
+
+def sha1_pk(*parts: str) -> str:
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+# chunk_index of the per-file marker row in an overlay partition; chunks are >= 0
+OVERLAY_MARKER_INDEX = -1
+# Overlay reads on the completion path (marker query and chunk search) share one level so a
+# marker is never seen without its chunks; Session also shows the service its own writes.
+# The sync path reads with Strong.
+OVERLAY_READ_CONSISTENCY = "Session"
+# how long a user without an overlay partition is remembered before has_partition is asked again
+OVERLAY_PARTITION_MISS_TTL_S = 30.0
+
+
+def expr_str_list(values: Iterable[str]) -> str:
+    return "[" + ", ".join(json.dumps(str(v)) for v in values) + "]"
 
-        fields = [
-            FieldSchema(name="pk", dtype=DataType.VARCHAR, is_primary=True, auto_id=False, max_length=256),
-            FieldSchema(name="repo", dtype=DataType.VARCHAR, max_length=128),
-            FieldSchema(name="branch", dtype=DataType.VARCHAR, max_length=64),
-            FieldSchema(name="commit", dtype=DataType.VARCHAR, max_length=64),
 
-            FieldSchema(name="file_path", dtype=DataType.VARCHAR, max_length=512),
-            FieldSchema(name="language", dtype=DataType.VARCHAR, max_length=32),
+def build_index_params(index_type: str, metric: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    index_type = index_type.upper()
+    if index_type not in INDEX_PRESETS:
+        raise ValueError(f"Unsupported index_type={index_type}. Choose from {sorted(INDEX_PRESETS)}")
+    return {
+        "index_type": index_type,
+        "metric_type": metric.upper(),
+        "params": {**INDEX_PRESETS[index_type], **(params or {})},
+    }
 
-            FieldSchema(name="chunk_index", dtype=DataType.INT32),
-            FieldSchema(name="chunk_hash", dtype=DataType.VARCHAR, max_length=64),
 
-            FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=65535),
-            FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=dim),
-        ]
+def build_search_params(index_type: str, metric: str, effort: Optional[int] = None, limit: int = 1) -> Dict[str, Any]:
+    key, default = SEARCH_EFFORT_PARAMS.get(index_type.upper(), ("ef", 128))
+    value = int(effort) if effort else default
+    if key in {"ef", "search_list"}:
+        # HNSW rejects ef < limit, DISKANN search_list < limit
+        value = max(value, limit)
+    return {"metric_type": metric.upper(), "params": {key: value}}
 
-        schema = CollectionSchema(fields, description="Code chunks for IDE autocomplete RAG")
-        col = Collection(name, schema=schema)
 
-        index_params = {
+def encode_vectors(vecs: List[List[float]], vector_dtype: str = "FLOAT_VECTOR") -> List[Any]:
+    vector_dtype = vector_dtype.upper()
+    if vector_dtype == "FLOAT_VECTOR":
+        return vecs
+
+    arr = np.asarray(vecs, dtype=np.float32)
+    if vector_dtype == "FLOAT16_VECTOR":
+        return list(arr.astype(np.float16))
+    if vector_dtype == "BFLOAT16_VECTOR":
+        try:
+            from ml_dtypes import bfloat16
+        except ImportError as e:
+            raise ImportError("BFLOAT16_VECTOR requires the `ml_dtypes` package") from e
+        return list(arr.astype(bfloat16))
+
+    raise ValueError(f"Unsupported vector_dtype={vector_dtype}. Choose from {sorted(VECTOR_DTYPES)}")
+
+
+def _vector_bytes(v: Any) -> bytes:
+    # query() returns half-precision vectors as raw bytes, sometimes wrapped in a list
+    if isinstance(v, list) and v and isinstance(v[0], bytes):
+        v = v[0]
+    return bytes(v)
+
+
+def decode_vectors(vecs: List[Any], vector_dtype: str = "FLOAT_VECTOR") -> np.ndarray:
+    vector_dtype = vector_dtype.upper()
+    if vector_dtype == "FLOAT16_VECTOR":
+        return np.stack([np.frombuffer(_vector_bytes(v), dtype=np.float16) for v in vecs]).astype(np.float32)
+    if vector_dtype == "BFLOAT16_VECTOR":
+        raw = np.stack([np.frombuffer(_vector_bytes(v), dtype=np.uint16) for v in vecs]).astype(np.uint32)
+        return (raw << 16).view(np.float32)
+    return np.asarray(vecs, dtype=np.float32)
+
+
+def build_schema(dim: int, vector_dtype: str = "FLOAT_VECTOR", layout: str = "flat") -> CollectionSchema:
+    fields = [
+        FieldSchema(name="pk", dtype=DataType.VARCHAR, is_primary=True, auto_id=False, max_length=256),
+        FieldSchema(name="repo", dtype=DataType.VARCHAR, max_length=128,
+                    is_partition_key=(layout == "partition_key")),
+        FieldSchema(name="branch", dtype=DataType.VARCHAR, max_length=64),
+        FieldSchema(name="commit", dtype=DataType.VARCHAR, max_length=64),
+
+        FieldSchema(name="file_path", dtype=DataType.VARCHAR, max_length=512),
+        FieldSchema(name="language", dtype=DataType.VARCHAR, max_length=32),
+
+        FieldSchema(name="chunk_index", dtype=DataType.INT32),
+        FieldSchema(name="chunk_hash", dtype=DataType.VARCHAR, max_length=64),
+
+        FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=65535),
+        FieldSchema(name="embedding", dtype=VECTOR_DTYPES[vector_dtype], dim=dim),
+    ]
+    if layout != "flat":
+        fields.append(FieldSchema(name="branches", dtype=DataType.ARRAY, element_type=DataType.VARCHAR,
+                                  max_capacity=256, max_length=64))
+
+    description = "Code chunks for IDE autocomplete RAG"
+    if layout != "flat":
+        description += f" [layout={layout}]"
+    schema = CollectionSchema(fields, description=description)
+    return schema
+
+
+class Milvus:
+    def __init__(self, host: Optional[str] = "127.0.0.1", port: int = 19530) -> None:
+        # host=None skips connecting, for use with a local stand-in collection
+        if host:
+            connections.connect(alias="default", host=host, port=port)
+        self._specs: Dict[str, Dict[str, Any]] = {}
+        # collection name -> side collection of pre-projection vectors (ensure_full_vectors)
+        self._full: Dict[str, Collection] = {}
+        # (collection, partition) -> known to exist (True) or missing until a monotonic time
+        self._overlay_parts: Dict[tuple, Any] = {}
+
+    def collection_spec(self, col: Collection) -> Dict[str, Any]:
+        """
+        Index type, metric, vector dtype and layout of a collection, read from
+        the collection itself so readers and writers agree on them.
+        """
+        spec = self._specs.get(col.name)
+        if spec is not None:
+            return spec
+
+        spec = {
             "index_type": "HNSW",
-            "metric_type": metric,
-            "params": {"M": 16, "efConstruction": 200},
+            "metric": "IP",
+            "vector_dtype": "FLOAT_VECTOR",
+            "layout": "flat",
+            "branches": False,
+            "fields": [f.name for f in col.schema.fields],
         }
-        col.create_index(field_name="embedding", index_params=index_params)
+        for f in col.schema.fields:
+            if f.name == "embedding":
+                spec["vector_dtype"] = f.dtype.name
+            if f.name == "branches":
+                spec["branches"] = True
+            if getattr(f, "is_partition_key", False):
+                spec["layout"] = "partition_key"
+        m = re.search(r"\[layout=(\w+)\]", col.schema.description or "")
+        if m:
+            spec["layout"] = m.group(1)
+        for idx in col.indexes:
+            if idx.field_name == "embedding":
+                spec["index_type"] = str(idx.params.get("index_type", spec["index_type"])).upper()
+                spec["metric"] = str(idx.params.get("metric_type", spec["metric"])).upper()
+
+        self._specs[col.name] = spec
+        return spec
+
+    def ensure_collection(
+            self,
+            name: str,
+            dim: int,
+            metric: str = "IP",
+            index_type: str = "HNSW",
+            index_params: Optional[Dict[str, Any]] = None,
+            vector_dtype: str = "FLOAT_VECTOR",
+            layout: str = "flat",
+            num_partitions: int = 64,
+    ) -> Collection:
+        """
+        layout:
+          flat               - one global index, repo/branch narrowed by filter expressions
+          partition_key      - `repo` is the Milvus partition key; repo-scoped queries
+                               only touch the hashed partition holding that repo
+          partition_per_repo - one named partition per repo, searched via partition_names
+        Non-flat layouts store each chunk once per (repo, file, content) and list the
+        branches it appears on in the `branches` array field.
+        """
+        if utility.has_collection(name):
+            return Collection(name)
+
+        vector_dtype = vector_dtype.upper()
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unsupported vector_dtype={vector_dtype}. Choose from {sorted(VECTOR_DTYPES)}")
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unsupported layout={layout}. Choose from {sorted(LAYOUTS)}")
+
+        schema = build_schema(dim, vector_dtype=vector_dtype, layout=layout)
+
+        if layout == "partition_key":
+            col = Collection(name, schema=schema, num_partitions=num_partitions)
+        else:
+            col = Collection(name, schema=schema)
+
+        col.create_index(field_name="embedding", index_params=build_index_params(index_type, metric, index_params))
 
         col.create_index("repo")
         col.create_index("file_path")
@@ -52,37 +257,325 @@ class Milvus:
         return col
 
 
-    def delete_file_chunks(self, col: Collection, repo: str, file_path: str):
-        expr = f'repo == "{repo}" && file_path == "{file_path}"'
-        col.delete(expr)
-        col.flush()
+    def ensure_full_vectors(self, col: Collection, dim: int, vector_dtype: str = "FLOAT_VECTOR") -> Collection:
+        """
+        Side collection `<collection>_full` holding the pre-projection vectors
+        of a projected collection under the same pks, written by upserts and
+        read by pk when reranking, so reranks need no model inference. Only
+        set up when reranking is enabled (RAG_RERANK_STORE).
 
+        It is never searched; the index only exists because Milvus needs one to
+        load. The collection must be memory-mapped, otherwise the raw full-dim
+        vectors would sit in query-node memory next to the reduced ones and
+        undo the saving of the projection, so a failure to enable mmap raises.
+        """
+        name = full_vectors_collection_name(col.name)
+        if utility.has_collection(name):
+            full = Collection(name)
+        else:
+            schema = CollectionSchema([
+                FieldSchema(name="pk", dtype=DataType.VARCHAR, is_primary=True, auto_id=False, max_length=256),
+                FieldSchema(name="embedding", dtype=VECTOR_DTYPES[vector_dtype.upper()], dim=dim),
+            ], description=f"Full-dim vectors for {col.name}")
+            full = Collection(name, schema=schema)
+            full.create_index(field_name="embedding", index_params=build_index_params("IVF_FLAT", "IP", {"nlist": 128}))
+
+        props = full.describe().get("properties") or {}
+        if str(props.get("mmap.enabled", "")).lower() != "true":
+            # mmap can only be changed on a released collection
+            full.release()
+            try:
+                full.set_properties({"mmap.enabled": True})
+            except MilvusException as e:
+                raise RuntimeError(f"Cannot enable mmap on {name} (needs Milvus >= 2.4 with mmap support); "
+                                   f"refusing to load full-dim vectors into memory") from e
+        full.load()
+        self._full[col.name] = full
+        return full
+
+
+    def repo_partitions(self, col: Collection, repo: Optional[str], create: bool = False) -> Optional[List[str]]:
+        """
+        Partition names that hold `repo` for the partition_per_repo layout, None
+        when the layout does not use named partitions (search everything).
+        """
+        if not repo or self.collection_spec(col)["layout"] != "partition_per_repo":
+            return None
+        name = repo_partition_name(repo)
+        if not col.has_partition(name):
+            if not create:
+                return []
+            col.create_partition(name)
+            col.load()
+        return [name]
+
+
+    def query_file_rows(
+            self,
+            col: Collection,
+            repo: str,
+            file_paths: List[str],
+            output_fields: Optional[List[str]] = None,
+            batch_size: int = 256,
+    ) -> List[Dict[str, Any]]:
+        partitions = self.repo_partitions(col, repo)
+        if partitions == [] or not file_paths:
+            return []
 
-    def upsert_chunks(self, col: Collection, chunks: List[Dict[str, Any]], embedder: Embedder, batch_size: int = 128):
+        rows: List[Dict[str, Any]] = []
+        paths = sorted(set(file_paths))
+        for i in range(0, len(paths), batch_size):
+            expr = f"repo == {json.dumps(repo)} && file_path in {expr_str_list(paths[i: i + batch_size])}"
+            it = col.query_iterator(
+                batch_size=1000,
+                expr=expr,
+                output_fields=output_fields or ["pk"],
+                partition_names=partitions,
+            )
+            while True:
+                batch = it.next()
+                if not batch:
+                    it.close()
+                    break
+                rows.extend(batch)
+        return rows
+
+
+    def query_file_pks(
+            self,
+            col: Collection,
+            repo: str,
+            file_paths: List[str],
+            batch_size: int = 256,
+    ) -> Set[str]:
+        return {r["pk"] for r in self.query_file_rows(col, repo, file_paths, batch_size=batch_size)}
+
+
+    def query_pk_rows(
+            self,
+            col: Collection,
+            pks: List[str],
+            output_fields: List[str],
+            repo: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        partitions = self.repo_partitions(col, repo)
+        if partitions == [] or not pks:
+            return []
+        return col.query(expr=f"pk in {expr_str_list(pks)}", output_fields=output_fields,
+                         partition_names=partitions)
+
+
+    def delete_by_pks(
+            self,
+            col: Collection,
+            pks: Iterable[str],
+            batch_size: int = 1000,
+            flush: bool = True,
+            repo: Optional[str] = None,
+    ) -> int:
+        pks = sorted(set(pks))
+        partitions = self.repo_partitions(col, repo)
+        if partitions == []:
+            return 0
+        full = self._full.get(col.name)
+        for i in range(0, len(pks), batch_size):
+            col.delete(f"pk in {expr_str_list(pks[i: i + batch_size])}",
+                       partition_name=partitions[0] if partitions else None)
+            if full is not None:
+                full.delete(f"pk in {expr_str_list(pks[i: i + batch_size])}")
+        if flush and pks:
+            col.flush()
+        return len(pks)
+
+
+    def delete_files_chunks(
+            self,
+            col: Collection,
+            repo: str,
+            file_paths: List[str],
+            batch_size: int = 256,
+            flush: bool = True,
+    ) -> None:
+        partitions = self.repo_partitions(col, repo)
+        if partitions == []:
+            return
+        paths = sorted(set(file_paths))
+        if self._full.get(col.name) is not None:
+            # the side store has no file_path: delete it by pk
+            self.delete_by_pks(col, self.query_file_pks(col, repo, paths, batch_size=batch_size), flush=flush, repo=repo)
+            return
+        for i in range(0, len(paths), batch_size):
+            col.delete(f"repo == {json.dumps(repo)} && file_path in {expr_str_list(paths[i: i + batch_size])}",
+                       partition_name=partitions[0] if partitions else None)
+        if flush and paths:
+            col.flush()
+
+
+    def delete_file_chunks(self, col: Collection, repo: str, file_path: str):
+        self.delete_files_chunks(col, repo, [file_path])
+
+
+    def _entity(self, spec: Dict[str, Any], x: Dict[str, Any], vec: Any) -> Dict[str, Any]:
+        ent = {
+            "pk": x["pk"],
+            "repo": x["repo"],
+            "branch": x.get("branch", ""),
+            "commit": x["commit"],
+            "file_path": str(x["file_path"]),
+            "language": x["language"],
+            "chunk_index": int(x["chunk_index"]),
+            "chunk_hash": x["chunk_hash"],
+            "text": x["text"],
+            "embedding": vec,
+        }
+        if spec["branches"]:
+            ent["branches"] = list(x.get("branches") or ([x["branch"]] if x.get("branch") else []))
+        return ent
+
+
+    def _upsert_entities(self, col: Collection, spec: Dict[str, Any], ents: List[Dict[str, Any]]) -> None:
+        by_repo: Dict[str, List[Dict[str, Any]]] = {}
+        for e in ents:
+            by_repo.setdefault(e["repo"], []).append(e)
+        for repo, rows in by_repo.items():
+            partitions = self.repo_partitions(col, repo, create=True)
+            col.upsert(rows, partition_name=partitions[0] if partitions else None)
+
+
+    def _embed_rows(self, col: Collection, spec: Dict[str, Any], embedder: Embedder,
+                    rows: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Encoded vectors for `rows`. With a projection and a full-vector side
+        store, the full-dim vectors are written there under the rows' pks
+        from the same model pass.
+        """
+        texts = [x["text"] for x in rows]
+        full_col = self._full.get(col.name)
+        if full_col is None or embedder.projection is None:
+            return encode_vectors(embedder.embed_batch(texts), spec["vector_dtype"])
+
+        full = np.asarray(embedder.embed_batch_full(texts), dtype=np.float32)
+        full_dtype = self.collection_spec(full_col)["vector_dtype"]
+        full_col.upsert([
+            {"pk": x["pk"], "embedding": v} for x, v in zip(rows, encode_vectors(full.tolist(), full_dtype))
+        ])
+        return encode_vectors(embedder.projection.apply(full).tolist(), spec["vector_dtype"])
+
+
+    def upsert_chunks(
+            self,
+            col: Collection,
+            chunks: List[Dict[str, Any]],
+            embedder: Embedder,
+            batch_size: int = 128,
+            flush: bool = True,
+    ):
         if not chunks:
             return
 
         col.load()
+        spec = self.collection_spec(col)
         for i in range(0, len(chunks), batch_size):
             batch = chunks[i: i + batch_size]
-            texts = [x["text"] for x in batch]
-            vecs = embedder.embed_batch(texts)
-
-            data = [
-                [x["pk"] for x in batch],
-                [x["repo"] for x in batch],
-                [x.get("branch", "") for x in batch],
-                [x["commit"] for x in batch],
-                [str(x["file_path"]) for x in batch],
-                [x["language"] for x in batch],
-                [int(x["chunk_index"]) for x in batch],
-                [x["chunk_hash"] for x in batch],
-                [x["text"] for x in batch],
-                vecs,
+            vecs = self._embed_rows(col, spec, embedder, batch)
+            self._upsert_entities(col, spec, [self._entity(spec, x, v) for x, v in zip(batch, vecs)])
+
+        if flush:
+            col.flush()
+
+
+    def sync_file_chunks(
+            self,
+            col: Collection,
+            repo: str,
+            file_paths: List[str],
+            chunks: List[Dict[str, Any]],
+            embedder: Embedder,
+            batch_size: int = 128,
+            branch: Optional[str] = None,
+    ) -> Dict[str, int]:
+        """
+        Make the stored chunks of `file_paths` match `chunks`: upsert by the
+        deterministic pk, delete pks that no longer exist, flush once.
+        """
+        spec = self.collection_spec(col)
+        if spec["branches"]:
+            return self._sync_branch_refs(col, spec, repo, branch or "", file_paths, chunks, embedder, batch_size)
+
+        existing = self.query_file_pks(col, repo, file_paths)
+        stale = existing - {x["pk"] for x in chunks}
+
+        deleted = self.delete_by_pks(col, stale, flush=False, repo=repo)
+        self.upsert_chunks(col, chunks, embedder=embedder, batch_size=batch_size, flush=False)
+
+        if deleted or chunks:
+            col.flush()
+
+        return {"upserted": len(chunks), "deleted": deleted}
+
+
+    def _sync_branch_refs(
+            self,
+            col: Collection,
+            spec: Dict[str, Any],
+            repo: str,
+            branch: str,
+            file_paths: List[str],
+            chunks: List[Dict[str, Any]],
+            embedder: Embedder,
+            batch_size: int,
+    ) -> Dict[str, int]:
+        # pk hashes repo|file_path|index|text, so identical content on another
+        # branch is the same row: only its `branches` list changes and the stored
+        # embedding is reused instead of re-embedding. Only pk + branches are read
+        # for the touched files; full rows are fetched for the reused pks only.
+        refs = {
+            r["pk"]: r.get("branches") or []
+            for r in self.query_file_rows(col, repo, file_paths, output_fields=["pk", "branches"])
+        }
+        new_chunks = {x["pk"]: x for x in chunks}
+
+        to_embed: List[Dict[str, Any]] = []
+        # pk -> new branches list for rows whose stored embedding is kept
+        reuse: Dict[str, List[str]] = {}
+        for pk, x in new_chunks.items():
+            branches = refs.get(pk)
+            if branches is None:
+                to_embed.append({**x, "branches": [branch]})
+            elif branch not in branches:
+                reuse[pk] = sorted(set(branches) | {branch})
+
+        stale: List[str] = []
+        for pk, branches in refs.items():
+            if pk in new_chunks or branch not in branches:
+                continue
+            remaining = [b for b in branches if b != branch]
+            if remaining:
+                reuse[pk] = remaining
+            else:
+                stale.append(pk)
+
+        deleted = self.delete_by_pks(col, stale, flush=False, repo=repo)
+
+        pks = sorted(reuse)
+        for i in range(0, len(pks), batch_size):
+            rows = self.query_pk_rows(col, pks[i: i + batch_size], output_fields=spec["fields"], repo=repo)
+            vecs = encode_vectors(
+                decode_vectors([r["embedding"] for r in rows], spec["vector_dtype"]).tolist(),
+                spec["vector_dtype"],
+            ) if rows else []
+            ents = [
+                self._entity(spec, {**new_chunks.get(r["pk"], r), "branches": reuse[r["pk"]]}, v)
+                for r, v in zip(rows, vecs)
             ]
-            col.insert(data)
+            self._upsert_entities(col, spec, ents)
 
-        col.flush()
+        self.upsert_chunks(col, to_embed, embedder=embedder, batch_size=batch_size, flush=False)
+
+        if deleted or reuse or to_embed:
+            col.flush()
+
+        return {"upserted": len(to_embed) + len(reuse), "embedded": len(to_embed), "deleted": deleted}
 
 
     def search_similar_chunks(
@@ -97,35 +590,65 @@ class Milvus:
             language: Optional[str] = None,
             exclude_file_path: Optional[str] = None,
             include_file_paths: Optional[List[str]] = None,
+            search_effort: Optional[int] = None,
+            max_results: int = 5,
+            overlay: Optional[Collection] = None,
+            user: Optional[str] = None,
+            partition_names: Optional[List[str]] = None,
+            min_chunk_index: Optional[int] = None,
+            consistency_level: Optional[str] = None,
     ) -> List[Dict[str, Any]]:
+        """
+        With `overlay` and `user`, results are merged with the user's overlay
+        partition (see sync_overlay_file): files present in the overlay are
+        served from it only. `partition_names` overrides the repo partitions;
+        `consistency_level` defaults to the collection's.
+        """
+        if overlay is not None and user:
+            return self._search_with_overlay(
+                col, overlay, user, query_vec, top_k, threshold, metric, repo, branch, language,
+                exclude_file_path, include_file_paths, search_effort, max_results,
+            )
+
         col.load()
+        spec = self.collection_spec(col)
+        partitions = partition_names or self.repo_partitions(col, repo)
+        if partitions == []:
+            return []
 
         filters: List[str] = []
         if repo:
-            filters.append(f'repo == "{repo}"')
+            # with a partition key this also prunes the search to the repo's partition
+            filters.append(f"repo == {json.dumps(repo)}")
         if branch:
-            filters.append(f'branch == "{branch}"')
+            if spec["branches"]:
+                filters.append(f"array_contains(branches, {json.dumps(branch)})")
+            else:
+                filters.append(f"branch == {json.dumps(branch)}")
         if language:
-            filters.append(f'language == "{language}"')
+            filters.append(f"language == {json.dumps(language)}")
         if exclude_file_path:
-            filters.append(f'file_path != "{exclude_file_path}"')
+            filters.append(f"file_path != {json.dumps(exclude_file_path)}")
         if include_file_paths:
-            ors = " || ".join([f'file_path == "{p}"' for p in include_file_paths])
-            filters.append(f"({ors})")
+            filters.append(f"file_path in {expr_str_list(include_file_paths)}")
+        if min_chunk_index is not None:
+            filters.append(f"chunk_index >= {int(min_chunk_index)}")
 
         expr = " && ".join(filters) if filters else None
 
         metric_upper = metric.upper()
 
-        search_params = {"metric_type": metric_upper, "params": {"ef": 128}}
+        search_params = build_search_params(spec["index_type"], metric_upper, search_effort, limit=top_k)
 
         # ---------- Milvus search ----------
         res = col.search(
-            data=[query_vec],
+            data=encode_vectors([query_vec], spec["vector_dtype"]),
             anns_field="embedding",
             param=search_params,
             limit=top_k,
             expr=expr,
+            partition_names=partitions,
+            **({"consistency_level": consistency_level} if consistency_level else {}),
             output_fields=[
                 "repo",
                 "branch",
@@ -135,7 +658,7 @@ class Milvus:
                 "chunk_index",
                 "chunk_hash",
                 "text",
-            ],
+            ] + (["branches"] if spec["branches"] else []),
         )
 
         hits = res[0] if res else []
@@ -169,6 +692,7 @@ class Milvus:
                     "metric": metric_upper,
                     "repo": ent.get("repo"),
                     "branch": ent.get("branch"),
+                    "branches": ent.get("branches"),
                     "commit": ent.get("commit"),
                     "file_path": ent.get("file_path"),
                     "language": ent.get("language"),
@@ -183,7 +707,174 @@ class Milvus:
 
         out.sort(key=lambda x: x["score"], reverse=True)
 
-        return out[:5]
+        return out[:max_results]
+
+
+    def _search_with_overlay(
+            self,
+            col: Collection,
+            overlay: Collection,
+            user: str,
+            query_vec: List[float],
+            top_k: int,
+            threshold: Optional[float],
+            metric: str,
+            repo: Optional[str],
+            branch: Optional[str],
+            language: Optional[str],
+            exclude_file_path: Optional[str],
+            include_file_paths: Optional[List[str]],
+            search_effort: Optional[int],
+            max_results: int,
+    ) -> List[Dict[str, Any]]:
+        main = self.search_similar_chunks(
+            col, query_vec, top_k=top_k, threshold=threshold, metric=metric, repo=repo, branch=branch,
+            language=language, exclude_file_path=exclude_file_path, include_file_paths=include_file_paths,
+            search_effort=search_effort, max_results=top_k,
+        )
+        shadowed = self.overlay_files(overlay, user, repo)
+        if not shadowed:
+            return main[:max_results]
+
+        # the overlay is the user's working tree: no branch filter, marker rows skipped
+        own = self.search_similar_chunks(
+            overlay, query_vec, top_k=top_k, threshold=threshold, metric=metric, repo=repo,
+            language=language, exclude_file_path=exclude_file_path, include_file_paths=include_file_paths,
+            search_effort=search_effort, max_results=top_k,
+            partition_names=[overlay_partition_name(user)], min_chunk_index=0,
+            consistency_level=OVERLAY_READ_CONSISTENCY,
+        )
+
+        out = [h for h in main if (h["repo"], h["file_path"]) not in shadowed]
+        out.extend({**h, "overlay": True} for h in own)
+        out.sort(key=lambda x: x["score"], reverse=True)
+        return out[:max_results]
+
+
+    def overlay_partition(self, col: Collection, user: str, create: bool = False) -> Optional[str]:
+        # cached: this runs on every completion request of every overlay user
+        name = overlay_partition_name(user)
+        known = self._overlay_parts.get((col.name, name))
+        if known is True:
+            return name
+        if not create and known is not None and time.monotonic() < known:
+            return None
+        if not col.has_partition(name):
+            if not create:
+                self._overlay_parts[(col.name, name)] = time.monotonic() + OVERLAY_PARTITION_MISS_TTL_S
+                return None
+            col.create_partition(name)
+            col.load()
+        self._overlay_parts[(col.name, name)] = True
+        return name
+
+
+    def overlay_files(self, col: Collection, user: str, repo: Optional[str] = None) -> Set[tuple]:
+        """(repo, file_path) of every file the user's overlay holds, deleted files included."""
+        partition = self.overlay_partition(col, user)
+        if partition is None:
+            return set()
+        expr = f"chunk_index == {OVERLAY_MARKER_INDEX}"
+        if repo:
+            expr = f"repo == {json.dumps(repo)} && " + expr
+        rows = self._query_rows(col, expr, ["repo", "file_path"], partition_names=[partition],
+                                consistency_level=OVERLAY_READ_CONSISTENCY)
+        return {(r["repo"], r["file_path"]) for r in rows}
+
+
+    def sync_overlay_file(
+            self,
+            col: Collection,
+            user: str,
+            repo: str,
+            file_path: str,
+            chunks: List[Dict[str, Any]],
+            embedder: Embedder,
+            batch_size: int = 32,
+    ) -> Dict[str, int]:
+        """
+        Replace one file of `user`'s overlay partition with `chunks` (empty for
+        a deleted file). Besides the chunks, each file keeps a marker row
+        (chunk_index == OVERLAY_MARKER_INDEX) so searches can drop the main
+        index's stale copy of the file even when no overlay chunk matches.
+        Not flushed: growing segments are searchable and per-save flushes
+        would leave many tiny segments.
+        """
+        col.load()
+        spec = self.collection_spec(col)
+        partition = self.overlay_partition(col, user, create=True)
+
+        # pks are per user: the same chunk may sit in several users' partitions
+        rows = [{**x, "pk": sha1_pk(user, x["pk"]), "branch": ""} for x in chunks]
+        marker = {
+            "pk": sha1_pk(user, repo, file_path, "marker"),
+            "repo": repo,
+            "commit": "",
+            "file_path": file_path,
+            "language": file_path.rsplit(".", 1)[-1].lower() if "." in file_path else "",
+            "chunk_index": OVERLAY_MARKER_INDEX,
+            "chunk_hash": "",
+            "text": "",
+        }
+
+        expr = f"repo == {json.dumps(repo)} && file_path == {json.dumps(file_path)}"
+        # Strong: the previous save of this file may not be flushed yet
+        existing = {r["pk"] for r in self._query_rows(col, expr, ["pk"], partition_names=[partition],
+                                                      consistency_level="Strong")}
+        stale = existing - {x["pk"] for x in rows} - {marker["pk"]}
+
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i: i + batch_size]
+            vecs = self._embed_rows(col, spec, embedder, batch)
+            col.upsert([self._entity(spec, x, v) for x, v in zip(batch, vecs)], partition_name=partition)
+
+        # markers are never searched (min_chunk_index=0); any valid vector will do
+        unit = [1.0] + [0.0] * (embedder.dim - 1)
+        col.upsert([self._entity(spec, marker, encode_vectors([unit], spec["vector_dtype"])[0])],
+                   partition_name=partition)
+
+        if stale:
+            col.delete(f"pk in {expr_str_list(sorted(stale))}", partition_name=partition)
+            if self._full.get(col.name) is not None:
+                self._full[col.name].delete(f"pk in {expr_str_list(sorted(stale))}")
+
+        return {"upserted": len(rows), "deleted": len(stale)}
+
+
+    def _query_rows(
+            self,
+            col: Collection,
+            expr: str,
+            output_fields: List[str],
+            partition_names: Optional[List[str]] = None,
+            consistency_level: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        it = col.query_iterator(batch_size=1000, expr=expr, output_fields=output_fields,
+                                partition_names=partition_names,
+                                **({"consistency_level": consistency_level} if consistency_level else {}))
+        rows: List[Dict[str, Any]] = []
+        while True:
+            batch = it.next()
+            if not batch:
+                it.close()
+                break
+            rows.extend(batch)
+        return rows
+
+
+    def clear_overlay(self, col: Collection, user: str, repo: Optional[str] = None) -> None:
+        partition = self.overlay_partition(col, user)
+        if partition is None:
+            return
+        expr = f"repo == {json.dumps(repo)}" if repo else f"chunk_index >= {OVERLAY_MARKER_INDEX}"
+        full = self._full.get(col.name)
+        if full is not None:
+            pks = [r["pk"] for r in self._query_rows(col, expr, ["pk"], partition_names=[partition],
+                                                     consistency_level="Strong")]
+            for i in range(0, len(pks), 1000):
+                full.delete(f"pk in {expr_str_list(pks[i: i + 1000])}")
+        col.delete(expr, partition_name=partition)
+        col.flush()
 
 
     def embed_and_search(
@@ -197,7 +888,18 @@ class Milvus:
             branch: Optional[str] = None,
             language: Optional[str] = None,
             exclude_file_path: Optional[str] = None,
+            search_effort: Optional[int] = None,
+            rerank_candidates: int = 0,
+            overlay: Optional[Collection] = None,
+            user: Optional[str] = None,
     ) -> List[Dict[str, Any]]:
+        if rerank_candidates and embedder.projection is not None:
+            return self._search_and_rerank_full(
+                query_text, col, embedder, rerank_candidates, threshold, metric,
+                repo, branch, language, exclude_file_path, search_effort,
+                overlay=overlay, user=user,
+            )
+
         vec = embedder.embed_batch([query_text])[0]
         return self.search_similar_chunks(
             col=col,
@@ -208,4 +910,91 @@ class Milvus:
             branch=branch,
             language=language,
             exclude_file_path=exclude_file_path,
-        )
\ No newline at end of file
+            search_effort=search_effort,
+            overlay=overlay,
+            user=user,
+        )
+
+
+    def _search_and_rerank_full(
+            self,
+            query_text: str,
+            col: Collection,
+            embedder: Embedder,
+            candidates: int,
+            threshold: Optional[float],
+            metric: str,
+            repo: Optional[str],
+            branch: Optional[str],
+            language: Optional[str],
+            exclude_file_path: Optional[str],
+            search_effort: Optional[int],
+            max_results: int = 5,
+            overlay: Optional[Collection] = None,
+            user: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        # ANN over the reduced vectors, then rescore the candidates with their
+        # stored full-dim vectors (ensure_full_vectors); the threshold applies to
+        # the full-dim score. Only the query is embedded.
+        q_full = np.asarray(embedder.embed_batch_full([query_text]), dtype=np.float32)
+        q_reduced = embedder.projection.apply(q_full)[0].tolist()
+
+        if self._full.get(col.name) is None:
+            # no side store: plain search on the reduced vectors
+            return self.search_similar_chunks(
+                col=col, query_vec=q_reduced, threshold=threshold, metric=metric, repo=repo, branch=branch,
+                language=language, exclude_file_path=exclude_file_path, search_effort=search_effort,
+                max_results=max_results, overlay=overlay, user=user,
+            )
+
+        hits = self.search_similar_chunks(
+            col=col,
+            query_vec=q_reduced,
+            top_k=candidates,
+            threshold=None,
+            metric=metric,
+            repo=repo,
+            branch=branch,
+            language=language,
+            exclude_file_path=exclude_file_path,
+            search_effort=search_effort,
+            max_results=candidates,
+            overlay=overlay,
+            user=user,
+        )
+        if not hits:
+            return []
+
+        full_vecs: Dict[str, np.ndarray] = {}
+        for from_overlay, source in ((False, col), (True, overlay)):
+            store = self._full.get(source.name) if source is not None else None
+            pks = [h["pk"] for h in hits if bool(h.get("overlay")) == from_overlay]
+            if store is None or not pks:
+                continue
+            rows = store.query(expr=f"pk in {expr_str_list(pks)}", output_fields=["pk", "embedding"])
+            if rows:
+                vecs = decode_vectors([r["embedding"] for r in rows], self.collection_spec(store)["vector_dtype"])
+                full_vecs.update(zip((r["pk"] for r in rows), vecs))
+
+        scores: List[float] = []
+        for h in hits:
+            v = full_vecs.get(h["pk"])
+            if v is None:
+                # ingested before the side store existed: keep the reduced score
+                scores.append(h["score"])
+            elif metric.upper() == "L2":
+                scores.append(-float(np.linalg.norm(v - q_full[0])))
+            else:
+                scores.append(float(v @ q_full[0]))
+
+        out: List[Dict[str, Any]] = []
+        for h, sc in zip(hits, scores):
+            if threshold is not None:
+                if metric.upper() == "L2" and -sc > float(threshold):
+                    continue
+                if metric.upper() != "L2" and sc < float(threshold):
+                    continue
+            out.append({**h, "score": sc, "reduced_score": h["score"]})
+
+        out.sort(key=lambda x: x["score"], reverse=True)
+        return out[:max_results]
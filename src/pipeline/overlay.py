@@ -0,0 +1,121 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from pipeline.chunking import split_code_text
+from pipeline.embedding import Embedder
+from pipeline.milvus import Milvus
+
+
+# returns the file's current text, or None when the file was deleted
+Loader = Callable[[], Optional[str]]
+Key = Tuple[str, str, str]
+
+
+class OverlayIndexer:
+    """
+    Background re-indexing of single saved files into per-user overlay
+    partitions (Milvus.sync_overlay_file).
+
+    - debounce: a file is indexed once no new event arrived for it for
+      `debounce_s`; a burst of saves costs one chunk + embed pass, with the
+      content read at that point (the loader), not at event time.
+    - low priority: while `busy()` is true (e.g. generation requests are
+      queued) the worker waits, up to `max_defer_s` per file.
+    """
+    def __init__(
+            self,
+            db: Milvus,
+            col,
+            embedder: Embedder,
+            debounce_s: float = 1.0,
+            busy: Optional[Callable[[], bool]] = None,
+            max_defer_s: float = 30.0,
+            batch_size: int = 32,
+    ):
+        self.db = db
+        self.col = col
+        self.embedder = embedder
+        self.debounce_s = debounce_s
+        self.busy = busy
+        self.max_defer_s = max_defer_s
+        self.batch_size = batch_size
+
+        self._pending: Dict[Key, Tuple[float, Loader]] = {}
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"indexed": 0, "deleted": 0, "coalesced": 0, "errors": 0}
+
+    def start(self) -> None:
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="overlay-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"pending": len(self._pending), **self._stats}
+
+    def submit(self, user: str, repo: str, file_path: str, loader: Loader) -> int:
+        """Queue (or re-arm) a file; returns the number of pending files."""
+        with self._cond:
+            key = (user, repo, file_path)
+            if key in self._pending:
+                self._stats["coalesced"] += 1
+            self._pending[key] = (time.monotonic(), loader)
+            self._cond.notify()
+            return len(self._pending)
+
+    def index_now(self, user: str, repo: str, file_path: str, text: Optional[str]) -> Dict[str, int]:
+        chunks = split_code_text(text, file_path, repo=repo, commit="") if text is not None else []
+        return self.db.sync_overlay_file(
+            self.col, user=user, repo=repo, file_path=file_path,
+            chunks=chunks, embedder=self.embedder, batch_size=self.batch_size,
+        )
+
+    def _next_ready(self) -> Optional[Tuple[Key, Loader]]:
+        # caller holds the lock; returns a settled file or waits for the earliest one
+        now = time.monotonic()
+        ready = [(t, k) for k, (t, _) in self._pending.items() if now - t >= self.debounce_s]
+        if ready:
+            _, key = min(ready)
+            return key, self._pending.pop(key)[1]
+        wait = min(t for t, _ in self._pending.values()) + self.debounce_s - now if self._pending else None
+        self._cond.wait(timeout=wait)
+        return None
+
+    def _wait_idle(self) -> None:
+        if self.busy is None:
+            return
+        deadline = time.monotonic() + self.max_defer_s
+        while self.busy() and time.monotonic() < deadline and not self._stop:
+            time.sleep(0.05)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+                item = self._next_ready()
+            if item is None:
+                continue
+
+            (user, repo, file_path), loader = item
+            self._wait_idle()
+            try:
+                text = loader()
+                self.index_now(user, repo, file_path, text)
+                outcome = "indexed" if text is not None else "deleted"
+            except Exception as e:
+                outcome = "errors"
+                print(f"[overlay] failed to index {repo}:{file_path} for {user}: {e}", flush=True)
+            with self._cond:
+                self._stats[outcome] += 1
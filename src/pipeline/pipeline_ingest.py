@@ -1,11 +1,14 @@
 import argparse
+import json
 import os
 from pathlib import Path
 from typing import List, Dict, Any, Optional, Set
 
-from pipeline.chunking import split_code_file
+from pipeline.chunking import split_code_file, normalize_file_path, read_text
 from pipeline.embedding import Embedder
 from pipeline.milvus import Milvus
+from pipeline.projection import load_projection
+from pipeline.symbols import SymbolIndex, extract_symbols, SYMBOL_EXTS
 
 
 DEFAULT_EXCLUDE_DIRS = {
@@ -93,6 +96,74 @@ def parse_changed_files_arg(repo_root: Path, include_roots: List[Path], changed_
     return files or None
 
 
+def parse_removed_files(repo_root: Path, include_roots: List[Path], changed_files_csv: str) -> List[str]:
+    raw = changed_files_csv.replace(",", "\n") if changed_files_csv.strip() else os.getenv("CHANGED_FILES", "")
+    rels = [x.strip() for x in raw.splitlines() if x.strip()]
+    out: List[str] = []
+    for r in rels:
+        p = (repo_root / r).resolve()
+        if p.exists():
+            continue
+        if p.suffix.lower() not in DEFAULT_INCLUDE_EXTS:
+            continue
+        if not is_under_any(p, include_roots):
+            continue
+        out.append(normalize_file_path(repo_root, p))
+    return out
+
+
+def ingest_files(
+        db: Milvus,
+        col,
+        repo_root: Path,
+        targets: List[Path],
+        repo: str,
+        branch: str,
+        commit: str,
+        embedder: Embedder,
+        batch_size: int = 128,
+        removed: Optional[List[str]] = None,
+        symbols: Optional[SymbolIndex] = None,
+) -> Dict[str, int]:
+    all_chunks: List[Dict[str, Any]] = []
+    all_symbols: List[Dict[str, Any]] = []
+    touched_files: List[str] = list(removed or [])
+
+    for fp in targets:
+        rel = normalize_file_path(repo_root, fp)
+        chunks = split_code_file(repo_root, fp, repo=repo, commit=commit)
+
+        touched_files.append(rel)
+        if symbols is not None and fp.suffix.lower() in SYMBOL_EXTS:
+            all_symbols.extend(extract_symbols(read_text(fp), rel, repo=repo))
+        if not chunks:
+            continue
+        for c in chunks:
+            c["branch"] = branch
+
+        all_chunks.extend(chunks)
+
+    stats = db.sync_file_chunks(
+        col,
+        repo=repo,
+        file_paths=touched_files,
+        chunks=all_chunks,
+        embedder=embedder,
+        batch_size=batch_size,
+        branch=branch,
+    )
+
+    if symbols is not None:
+        symbols.replace_files(repo, touched_files, all_symbols)
+
+    return {
+        "files": len(set(touched_files)),
+        "chunks": len(all_chunks),
+        "deleted": stats["deleted"],
+        "symbols": len(all_symbols),
+    }
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--repo_root", required=True)
@@ -104,10 +175,22 @@ def main():
     ap.add_argument("--milvus_port", default=os.getenv("MILVUS_PORT", "19530"))
     ap.add_argument("--collection", default=os.getenv("MILVUS_COLLECTION", "code_chunks"))
     ap.add_argument("--metric", default=os.getenv("MILVUS_METRIC", "IP"))
+    ap.add_argument("--index_type", default=os.getenv("MILVUS_INDEX_TYPE", "HNSW"),
+                    help="HNSW | IVF_FLAT | IVF_SQ8 | IVF_PQ | DISKANN (only used when creating the collection)")
+    ap.add_argument("--index_params", default=os.getenv("MILVUS_INDEX_PARAMS", ""),
+                    help='JSON overrides for index build params, e.g. \'{"nlist": 2048}\'')
+    ap.add_argument("--vector_dtype", default=os.getenv("MILVUS_VECTOR_DTYPE", "FLOAT_VECTOR"),
+                    help="FLOAT_VECTOR | FLOAT16_VECTOR | BFLOAT16_VECTOR (only used when creating the collection)")
+    ap.add_argument("--layout", default=os.getenv("MILVUS_LAYOUT", "flat"),
+                    help="flat | partition_key | partition_per_repo (only used when creating the collection)")
+    ap.add_argument("--num_partitions", type=int, default=int(os.getenv("MILVUS_NUM_PARTITIONS", "64")),
+                    help="Partition count for the partition_key layout.")
 
     ap.add_argument("--embed_model", default=os.getenv("EMBED_MODEL", "krlvi/sentence-t5-base-nlpl-code_search_net"))
     ap.add_argument("--embed_dim", type=int, default=int(os.getenv("EMBED_DIM", "768")))
     ap.add_argument("--batch_size", type=int, default=128)
+    ap.add_argument("--rerank_store", action="store_true", default=os.getenv("RAG_RERANK_STORE", "0") == "1",
+                    help="With a projection, also write full-dim vectors for reranking (same setting as the service).")
 
     ap.add_argument("--changed_files", default="", help="Comma-separated changed files relative to repo root.")
     ap.add_argument("--full", action="store_true", help="Ingest full repo (ignore changed files).")
@@ -115,6 +198,9 @@ def main():
     ap.add_argument("--include_dirs", default=os.getenv("INGEST_INCLUDE_DIRS", "src"),
                     help="Comma-separated dirs (relative to repo_root) to ingest. Default: src")
 
+    ap.add_argument("--symbol_index", default=os.getenv("SYMBOL_INDEX_PATH", ""),
+                    help="SQLite file for the definition index (functions/classes/methods). Empty = skip.")
+
     args = ap.parse_args()
     repo_root = Path(args.repo_root).resolve()
 
@@ -124,9 +210,24 @@ def main():
         raise SystemExit(f"No valid include dirs found in {repo_root}")
 
     db = Milvus(args.milvus_host, args.milvus_port)
-    col = db.ensure_collection(args.collection, dim=args.embed_dim, metric=args.metric)
-
-    embedder = Embedder(dim=args.embed_dim, model_path=args.embed_model, normalize=True)
+    projection = load_projection(args.collection)
+    if projection is not None and projection.in_dim != args.embed_dim:
+        raise SystemExit(f"Projection for {args.collection} expects {projection.in_dim}-d embeddings, got --embed_dim {args.embed_dim}")
+
+    embedder = Embedder(dim=args.embed_dim, model_path=args.embed_model, normalize=True, projection=projection)
+
+    col = db.ensure_collection(
+        args.collection,
+        dim=embedder.dim,
+        metric=args.metric,
+        index_type=args.index_type,
+        index_params=json.loads(args.index_params) if args.index_params.strip() else None,
+        vector_dtype=args.vector_dtype,
+        layout=args.layout,
+        num_partitions=args.num_partitions,
+    )
+    if args.rerank_store and projection is not None:
+        db.ensure_full_vectors(col, dim=projection.in_dim)
 
     targets = None
     if not args.full:
@@ -136,28 +237,28 @@ def main():
     if not targets:
         targets = iter_repo_files(repo_root, include_roots)
 
-    all_chunks: List[Dict[str, Any]] = []
-    touched_files: List[str] = []
-
-    for fp in targets:
-        rel = str(fp.relative_to(repo_root)).replace("\\", "/")
-        chunks = split_code_file(repo_root, fp, repo=args.repo, commit=args.commit)
-
-        if not chunks:
-            continue
-        for c in chunks:
-            c["branch"] = args.branch
-
-        all_chunks.extend(chunks)
-        touched_files.append(rel)
-
-    for rel in sorted(set(touched_files)):
-        db.delete_file_chunks(col, args.repo, rel)
-
-    db.upsert_chunks(col, all_chunks, embedder=embedder, batch_size=args.batch_size)
-
-    print(f"Done. include_dirs={args.include_dirs} files={len(set(touched_files))} chunks={len(all_chunks)} collection={args.collection}")
-
+    removed = parse_removed_files(repo_root, include_roots, args.changed_files) if not args.full else []
+    symbols = SymbolIndex(args.symbol_index) if args.symbol_index else None
+
+    stats = ingest_files(
+        db,
+        col,
+        repo_root=repo_root,
+        targets=targets,
+        repo=args.repo,
+        branch=args.branch,
+        commit=args.commit,
+        embedder=embedder,
+        batch_size=args.batch_size,
+        removed=removed,
+        symbols=symbols,
+    )
+
+    if symbols is not None:
+        symbols.close()
+
+    print(f"Done. include_dirs={args.include_dirs} files={stats['files']} chunks={stats['chunks']} "
+          f"deleted={stats['deleted']} symbols={stats['symbols']} collection={args.collection}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,164 @@
+import argparse
+import os
+from typing import List, Optional
+
+import numpy as np
+from pymilvus import (
+    FieldSchema,
+    CollectionSchema,
+    DataType,
+    Collection,
+    utility, connections
+)
+
+
+PROJECTION_METHODS = {"pca", "matryoshka"}
+
+
+def projection_collection_name(collection: str) -> str:
+    return f"{collection}_projection"
+
+
+class Projection:
+    """
+    Linear map from full embedding dims to `out_dim`: y = normalize((x - mean) @ components.T).
+    PCA learns `mean`/`components` from a sample; Matryoshka keeps the leading dims.
+    """
+    def __init__(self, mean: np.ndarray, components: np.ndarray, method: str = "pca", normalize: bool = True):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.method = method
+        self.normalize = normalize
+
+    @property
+    def in_dim(self) -> int:
+        return int(self.components.shape[1])
+
+    @property
+    def out_dim(self) -> int:
+        return int(self.components.shape[0])
+
+    @classmethod
+    def fit_pca(cls, vectors: np.ndarray, out_dim: int) -> "Projection":
+        x = np.asarray(vectors, dtype=np.float32)
+        if out_dim > min(x.shape):
+            raise ValueError(f"out_dim={out_dim} needs at least {out_dim} samples of dim >= {out_dim}, got {x.shape}")
+        mean = x.mean(axis=0)
+        _, _, vt = np.linalg.svd(x - mean, full_matrices=False)
+        return cls(mean, vt[:out_dim], method="pca")
+
+    @classmethod
+    def matryoshka(cls, in_dim: int, out_dim: int) -> "Projection":
+        if out_dim > in_dim:
+            raise ValueError(f"out_dim={out_dim} > in_dim={in_dim}")
+        return cls(np.zeros(in_dim, dtype=np.float32), np.eye(in_dim, dtype=np.float32)[:out_dim], method="matryoshka")
+
+    def apply(self, vectors) -> np.ndarray:
+        y = (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+        if self.normalize:
+            y = y / np.linalg.norm(y, axis=1, keepdims=True).clip(min=1e-12)
+        return y
+
+    def explained_variance(self, vectors: np.ndarray) -> float:
+        x = np.asarray(vectors, dtype=np.float32) - self.mean
+        total = float((x ** 2).sum())
+        kept = float(((x @ self.components.T) ** 2).sum())
+        return kept / total if total > 0 else 0.0
+
+
+def collection_in_use(collection: str) -> bool:
+    return utility.has_collection(collection) and Collection(collection).num_entities > 0
+
+
+def save_projection(collection: str, proj: Projection) -> None:
+    """
+    Store the projection next to `collection` as `<collection>_projection`
+    (row 0 = mean, rows 1..out_dim = components) so ingestion and the service
+    always load the same matrix.
+
+    Refuses when `collection` already holds vectors: they were reduced with the
+    current projection and would no longer match queries reduced with the new one.
+    """
+    if collection_in_use(collection):
+        raise ValueError(f"Collection {collection} is not empty; drop it or use a new collection before replacing its projection")
+    name = projection_collection_name(collection)
+    if utility.has_collection(name):
+        utility.drop_collection(name)
+
+    fields = [
+        FieldSchema(name="row", dtype=DataType.INT64, is_primary=True, auto_id=False),
+        FieldSchema(name="vec", dtype=DataType.FLOAT_VECTOR, dim=proj.in_dim),
+    ]
+    schema = CollectionSchema(fields, description=f"Embedding projection for {collection} [method={proj.method}]")
+    col = Collection(name, schema=schema)
+
+    rows = [proj.mean] + list(proj.components)
+    col.insert([list(range(len(rows))), [r.tolist() for r in rows]])
+    col.flush()
+    col.create_index(field_name="vec", index_params={"index_type": "FLAT", "metric_type": "IP", "params": {}})
+
+
+def load_projection(collection: str) -> Optional[Projection]:
+    name = projection_collection_name(collection)
+    if not utility.has_collection(name):
+        return None
+
+    col = Collection(name)
+    col.load()
+    rows = col.query(expr="row >= 0", output_fields=["row", "vec"], limit=16384)
+    if not rows:
+        return None
+    rows.sort(key=lambda r: r["row"])
+
+    method = "matryoshka" if "[method=matryoshka]" in (col.schema.description or "") else "pca"
+    vecs = np.asarray([r["vec"] for r in rows], dtype=np.float32)
+    return Projection(vecs[0], vecs[1:], method=method)
+
+
+def sample_vectors(collection: str, limit: int, batch_size: int = 1000) -> np.ndarray:
+    col = Collection(collection)
+    col.load()
+    it = col.query_iterator(batch_size=batch_size, limit=limit, expr="", output_fields=["embedding"])
+    vecs: List[List[float]] = []
+    while True:
+        rows = it.next()
+        if not rows:
+            it.close()
+            break
+        vecs.extend(r["embedding"] for r in rows)
+    return np.asarray(vecs, dtype=np.float32)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fit and store an embedding projection for a Milvus collection.")
+    ap.add_argument("--milvus_host", default=os.getenv("MILVUS_HOST", "127.0.0.1"))
+    ap.add_argument("--milvus_port", default=os.getenv("MILVUS_PORT", "19530"))
+    ap.add_argument("--collection", required=True, help="Collection that will store the reduced vectors.")
+    ap.add_argument("--source_collection", default="",
+                    help="Full-dim FLOAT_VECTOR collection to sample embeddings from (required for pca).")
+    ap.add_argument("--method", default="pca", choices=sorted(PROJECTION_METHODS))
+    ap.add_argument("--in_dim", type=int, default=int(os.getenv("EMBED_DIM", "768")))
+    ap.add_argument("--out_dim", type=int, default=256)
+    ap.add_argument("--sample", type=int, default=20000)
+    args = ap.parse_args()
+
+    connections.connect(alias="default", host=args.milvus_host, port=args.milvus_port)
+    if collection_in_use(args.collection):
+        raise SystemExit(f"Collection {args.collection} is not empty; a new projection would not match its vectors. "
+                         f"Drop it or pass a new --collection.")
+
+    if args.method == "matryoshka":
+        proj = Projection.matryoshka(args.in_dim, args.out_dim)
+    else:
+        if not args.source_collection:
+            raise SystemExit("--source_collection is required for --method pca")
+        sample = sample_vectors(args.source_collection, args.sample)
+        proj = Projection.fit_pca(sample, args.out_dim)
+        print(f"explained_variance={proj.explained_variance(sample):.4f} samples={len(sample)}")
+
+    save_projection(args.collection, proj)
+    print(f"Saved {proj.method} projection {proj.in_dim}->{proj.out_dim} to {projection_collection_name(args.collection)}")
+
+
+if __name__ == '__main__':
+    main()
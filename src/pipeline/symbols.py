@@ -0,0 +1,196 @@
+import ast
+import builtins
+import keyword
+import re
+import sqlite3
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Iterable
+
+
+SYMBOL_EXTS = {".py"}
+
+_IGNORED_NAMES = set(keyword.kwlist) | set(dir(builtins)) | {"self", "cls"}
+_IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def _first_doc_paragraph(node: ast.AST, max_chars: int = 300) -> str:
+    doc = ast.get_docstring(node) or ""
+    para = doc.strip().split("\n\n", 1)[0].strip()
+    return para[:max_chars]
+
+
+def _signature(node: ast.AST) -> str:
+    if isinstance(node, ast.ClassDef):
+        bases = [ast.unparse(b) for b in node.bases] + [ast.unparse(k) for k in node.keywords]
+        return f"class {node.name}({', '.join(bases)}):" if bases else f"class {node.name}:"
+
+    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    ret = f" -> {ast.unparse(node.returns)}" if node.returns is not None else ""
+    return f"{prefix} {node.name}({ast.unparse(node.args)}){ret}:"
+
+
+def extract_python_symbols(text: str, file_path: str, repo: str) -> List[Dict[str, Any]]:
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return []
+
+    out: List[Dict[str, Any]] = []
+
+    def visit(body: Iterable[ast.stmt], scope: List[str], in_class: bool) -> None:
+        for node in body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            if isinstance(node, ast.ClassDef):
+                kind = "class"
+            else:
+                kind = "method" if in_class else "function"
+            out.append({
+                "repo": repo,
+                "name": node.name,
+                "qualname": ".".join(scope + [node.name]),
+                "kind": kind,
+                "file_path": file_path,
+                "line": node.lineno,
+                "end_line": getattr(node, "end_lineno", node.lineno) or node.lineno,
+                "signature": _signature(node),
+                "doc": _first_doc_paragraph(node),
+            })
+            # nested functions are implementation details; class bodies are not
+            if isinstance(node, ast.ClassDef):
+                visit(node.body, scope + [node.name], in_class=True)
+
+    visit(tree.body, [], in_class=False)
+    return out
+
+
+def extract_symbols(text: str, file_path: str, repo: str) -> List[Dict[str, Any]]:
+    if Path(file_path).suffix.lower() in SYMBOL_EXTS:
+        return extract_python_symbols(text, file_path, repo)
+    return []
+
+
+def identifiers_near_cursor(prefix: str, suffix: str = "", max_lines: int = 20, max_names: int = 8) -> List[str]:
+    """
+    Identifiers the user is likely to need a definition for, most recent first,
+    taken from the last `max_lines` lines of the prefix and the rest of the
+    cursor line.
+    """
+    lines = prefix.splitlines()[-max_lines:]
+    cursor_tail = suffix.split("\n", 1)[0] if suffix else ""
+    window = "\n".join(lines) + cursor_tail
+
+    names: List[str] = []
+    seen = set()
+    for m in reversed(list(_IDENT_RE.finditer(window))):
+        name = m.group(0)
+        if name in seen or name in _IGNORED_NAMES or len(name) < 3:
+            continue
+        if name.startswith("__") and name.endswith("__"):
+            continue
+        seen.add(name)
+        names.append(name)
+        if len(names) >= max_names:
+            break
+    return names
+
+
+def cursor_partial_word(prefix: str) -> str:
+    m = re.search(r"[A-Za-z_][A-Za-z0-9_]*$", prefix)
+    return m.group(0) if m else ""
+
+
+class SymbolIndex:
+    """
+    On-disk (SQLite) table of definitions keyed by (repo, name).
+    """
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self._ensure_schema()
+
+    def _ensure_schema(self) -> None:
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS symbols (
+                repo TEXT NOT NULL,
+                name TEXT NOT NULL,
+                qualname TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                line INTEGER NOT NULL,
+                end_line INTEGER NOT NULL,
+                signature TEXT NOT NULL,
+                doc TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_symbols_repo_name ON symbols (repo, name);
+            CREATE INDEX IF NOT EXISTS idx_symbols_name ON symbols (name);
+            CREATE INDEX IF NOT EXISTS idx_symbols_repo_file ON symbols (repo, file_path);
+            """
+        )
+        self.conn.commit()
+
+    def replace_files(self, repo: str, file_paths: List[str], symbols: List[Dict[str, Any]]) -> None:
+        paths = sorted(set(file_paths))
+        with self.conn:
+            for i in range(0, len(paths), 500):
+                batch = paths[i: i + 500]
+                self.conn.execute(
+                    f"DELETE FROM symbols WHERE repo = ? AND file_path IN ({','.join('?' * len(batch))})",
+                    [repo, *batch],
+                )
+            self.conn.executemany(
+                "INSERT INTO symbols (repo, name, qualname, kind, file_path, line, end_line, signature, doc) "
+                "VALUES (:repo, :name, :qualname, :kind, :file_path, :line, :end_line, :signature, :doc)",
+                symbols,
+            )
+
+    def lookup(
+            self,
+            names: List[str],
+            repo: Optional[str] = None,
+            partial: str = "",
+            exclude_file_path: Optional[str] = None,
+            limit: int = 5,
+    ) -> List[Dict[str, Any]]:
+        cols = ["repo", "name", "qualname", "kind", "file_path", "line", "end_line", "signature", "doc"]
+        where_repo = " AND repo = ?" if repo else ""
+        args_repo = [repo] if repo else []
+
+        found: Dict[str, List[Dict[str, Any]]] = {}
+        if names:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(cols)} FROM symbols WHERE name IN ({','.join('?' * len(names))}){where_repo}",
+                [*names, *args_repo],
+            ).fetchall()
+            for r in rows:
+                d = dict(zip(cols, r))
+                found.setdefault(d["name"], []).append(d)
+
+        out: List[Dict[str, Any]] = []
+        if partial and partial not in found:
+            # range scan on the name index = prefix match for the word being typed
+            rows = self.conn.execute(
+                f"SELECT {', '.join(cols)} FROM symbols WHERE name >= ? AND name < ?{where_repo} LIMIT ?",
+                [partial, partial + "\U0010ffff", *args_repo, limit],
+            ).fetchall()
+            out.extend(dict(zip(cols, r)) for r in rows)
+
+        for n in names:
+            out.extend(found.get(n, []))
+
+        seen = set()
+        uniq: List[Dict[str, Any]] = []
+        for d in out:
+            key = (d["repo"], d["file_path"], d["line"])
+            if key in seen or (exclude_file_path and d["file_path"] == exclude_file_path):
+                continue
+            seen.add(key)
+            uniq.append(d)
+        return uniq[:limit]
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,149 @@
+import argparse
+import getpass
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from pipeline.chunking import normalize_file_path, read_text
+from pipeline.embedding import Embedder
+from pipeline.milvus import Milvus, overlay_collection_name
+from pipeline.overlay import OverlayIndexer
+from pipeline.pipeline_ingest import DEFAULT_EXCLUDE_DIRS, DEFAULT_INCLUDE_EXTS, parse_include_dirs, is_under_any
+from pipeline.projection import load_projection
+
+
+def is_indexable(path: Path, include_roots: List[Path]) -> bool:
+    if path.suffix.lower() not in DEFAULT_INCLUDE_EXTS:
+        return False
+    if any(d in path.parts for d in DEFAULT_EXCLUDE_DIRS):
+        return False
+    return is_under_any(path, include_roots)
+
+
+def file_loader(path: Path):
+    def load() -> Optional[str]:
+        return read_text(path) if path.is_file() else None
+    return load
+
+
+def git_dirty_files(repo_root: Path) -> List[Path]:
+    """Modified, added, deleted and untracked files of the working tree vs HEAD."""
+    try:
+        out = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=all"],
+            cwd=repo_root, capture_output=True, text=True, check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    paths: List[Path] = []
+    for line in out.splitlines():
+        name = line[3:].split(" -> ")[-1].strip().strip('"')
+        if name:
+            paths.append((repo_root / name).resolve())
+    return paths
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Watch a working tree and keep the user's overlay index up to date.")
+    ap.add_argument("--repo_root", default=".")
+    ap.add_argument("--repo", required=True, help="Repo id, the same one CI ingests the main index under.")
+    ap.add_argument("--user", default=os.getenv("COPILOT_USER", getpass.getuser()),
+                    help="Overlay owner; send the same value as `user` in /generate requests.")
+    ap.add_argument("--include_dirs", default=os.getenv("INGEST_INCLUDE_DIRS", "src"))
+
+    ap.add_argument("--milvus_host", default=os.getenv("MILVUS_HOST", "127.0.0.1"))
+    ap.add_argument("--milvus_port", default=os.getenv("MILVUS_PORT", "19530"))
+    ap.add_argument("--collection", default=os.getenv("MILVUS_COLLECTION", "code_chunks"))
+    ap.add_argument("--metric", default=os.getenv("MILVUS_METRIC", "IP"))
+    ap.add_argument("--index_type", default=os.getenv("MILVUS_INDEX_TYPE", "HNSW"),
+                    help="Same as the main collection (only used when creating the overlay collection)")
+    ap.add_argument("--index_params", default=os.getenv("MILVUS_INDEX_PARAMS", ""),
+                    help='JSON overrides for index build params, e.g. \'{"nlist": 2048}\'')
+    ap.add_argument("--vector_dtype", default=os.getenv("MILVUS_VECTOR_DTYPE", "FLOAT_VECTOR"),
+                    help="Same as the main collection (only used when creating the overlay collection)")
+
+    ap.add_argument("--embed_model", default=os.getenv("EMBED_MODEL", "krlvi/sentence-t5-base-nlpl-code_search_net"))
+    ap.add_argument("--embed_dim", type=int, default=int(os.getenv("EMBED_DIM", "768")))
+
+    ap.add_argument("--rerank_store", action="store_true", default=os.getenv("RAG_RERANK_STORE", "0") == "1",
+                    help="With a projection, also write full-dim vectors for reranking (same setting as the service).")
+    ap.add_argument("--debounce_ms", type=int, default=1000, help="Quiet period after the last event for a file.")
+    ap.add_argument("--nice", type=int, default=10, help="Process niceness increment (0 = unchanged).")
+    ap.add_argument("--no_initial_scan", action="store_true",
+                    help="Do not index the files `git status` reports as changed at startup.")
+    ap.add_argument("--reset", action="store_true", help="Clear this user's overlay for --repo before starting.")
+    args = ap.parse_args()
+
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError as e:
+        raise SystemExit("watch mode requires the `watchdog` package") from e
+
+    if args.nice:
+        os.nice(args.nice)
+
+    repo_root = Path(args.repo_root).resolve()
+    include_roots = parse_include_dirs(repo_root, args.include_dirs)
+    if not include_roots:
+        raise SystemExit(f"No valid include dirs found in {repo_root}")
+
+    db = Milvus(args.milvus_host, args.milvus_port)
+    embedder = Embedder(dim=args.embed_dim, model_path=args.embed_model, normalize=True,
+                        projection=load_projection(args.collection))
+    col = db.ensure_collection(
+        overlay_collection_name(args.collection),
+        dim=embedder.dim,
+        metric=args.metric,
+        index_type=args.index_type,
+        index_params=json.loads(args.index_params) if args.index_params.strip() else None,
+        vector_dtype=args.vector_dtype,
+    )
+    if args.rerank_store and embedder.projection is not None:
+        db.ensure_full_vectors(col, dim=embedder.projection.in_dim)
+    if args.reset:
+        db.clear_overlay(col, args.user, repo=args.repo)
+
+    indexer = OverlayIndexer(db, col, embedder, debounce_s=args.debounce_ms / 1000.0)
+
+    def enqueue(path: Path) -> None:
+        if is_indexable(path, include_roots):
+            indexer.submit(args.user, args.repo, normalize_file_path(repo_root, path), file_loader(path))
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory or event.event_type not in {"created", "modified", "deleted", "moved"}:
+                return
+            enqueue(Path(event.src_path).resolve())
+            if event.event_type == "moved":
+                enqueue(Path(event.dest_path).resolve())
+
+    indexer.start()
+    if not args.no_initial_scan:
+        for p in git_dirty_files(repo_root):
+            enqueue(p)
+
+    observer = Observer()
+    for root in include_roots:
+        observer.schedule(Handler(), str(root), recursive=True)
+    observer.start()
+    print(f"[watch] user={args.user} repo={args.repo} roots={[str(r) for r in include_roots]} "
+          f"collection={col.name}", flush=True)
+
+    try:
+        while True:
+            time.sleep(30)
+            print(f"[watch] {indexer.stats()}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+        indexer.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of every thread (event loop included) at a fixed
+    interval and keeps folded-stack counts, the input format of flamegraph.pl
+    and speedscope.
+    """
+    def __init__(self, interval_s: float = 0.005, max_depth: int = 64):
+        self.interval_s = interval_s
+        self.max_depth = max_depth
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval_s):
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack: List[str] = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in self.counts.most_common():
+                f.write(f"{stack} {n}\n")
+
+
+class Profiler:
+    """
+    On-demand profiling of the generation path. Off unless `enabled`; once
+    armed it wraps the next `requests` generations (or all generations for
+    `seconds`, whichever ends first) in torch.profiler and runs a Python stack
+    sampler, then writes into `<out_dir>/<session>/`:
+
+      request-<i>.trace.json  Chrome trace per profiled request (chrome://tracing, Perfetto)
+      summary.txt             operator table (key_averages) per request
+      python.folded           folded Python stacks from the sampler
+    """
+    def __init__(self, enabled: bool = False, out_dir: str = "profiles", max_requests: int = 20, max_seconds: float = 120.0):
+        self.enabled = enabled
+        self.out_dir = out_dir
+        self.max_requests = max_requests
+        self.max_seconds = max_seconds
+
+        self._lock = threading.Lock()
+        self._session: Optional[Dict[str, Any]] = None
+        self._sampler: Optional[StackSampler] = None
+        self._last: Optional[Dict[str, Any]] = None
+
+    def arm(self, requests: Optional[int] = None, seconds: Optional[float] = None) -> Dict[str, Any]:
+        if not self.enabled:
+            raise RuntimeError("profiling is disabled on this server")
+        requests = min(int(requests or 1), self.max_requests)
+        seconds = min(float(seconds or self.max_seconds), self.max_seconds)
+
+        with self._lock:
+            if self._session is not None:
+                raise RuntimeError("a profiling session is already armed")
+            name = time.strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(self.out_dir, name)
+            os.makedirs(path, exist_ok=True)
+            self._session = {
+                "name": name,
+                "path": path,
+                "remaining": requests,
+                "profiled": 0,
+                "until": time.monotonic() + seconds,
+                "tables": [],
+            }
+            # end the window (and the sampler) on time even if no request arrives
+            timer = threading.Timer(seconds, self._expire, args=(self._session,))
+            timer.daemon = True
+            self._session["timer"] = timer
+            self._sampler = StackSampler()
+            self._sampler.start()
+            timer.start()
+            return self.status()
+
+    def status(self) -> Dict[str, Any]:
+        s = self._session
+        if s is None:
+            return {"enabled": self.enabled, "armed": False, "last": self._last}
+        return {
+            "enabled": self.enabled,
+            "armed": True,
+            "session": s["name"],
+            "path": s["path"],
+            "remaining_requests": s["remaining"],
+            "remaining_s": round(max(0.0, s["until"] - time.monotonic()), 1),
+            "profiled": s["profiled"],
+        }
+
+    def _take_slot(self) -> Optional[tuple]:
+        with self._lock:
+            s = self._session
+            if s is None:
+                return None
+            if s["remaining"] <= 0 or time.monotonic() > s["until"]:
+                self._finish_locked()
+                return None
+            s["remaining"] -= 1
+            s["profiled"] += 1
+            return s["profiled"], s
+
+    def _expire(self, session: Dict[str, Any]) -> None:
+        with self._lock:
+            if self._session is session:
+                self._finish_locked()
+
+    def _finish_locked(self) -> None:
+        s = self._session
+        if s is None:
+            return
+        s["timer"].cancel()
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler.write_folded(os.path.join(s["path"], "python.folded"))
+            self._sampler = None
+        with open(os.path.join(s["path"], "summary.txt"), "w", encoding="utf-8") as f:
+            f.write("\n\n".join(s["tables"]) or "no requests were profiled\n")
+        self._last = {"session": s["name"], "path": s["path"], "profiled": s["profiled"]}
+        self._session = None
+
+    def finish(self) -> None:
+        with self._lock:
+            self._finish_locked()
+
+    def maybe_finish(self) -> None:
+        """Close a session whose time window ran out even if no request arrived."""
+        with self._lock:
+            s = self._session
+            if s is not None and (s["remaining"] <= 0 or time.monotonic() > s["until"]):
+                self._finish_locked()
+
+    @contextmanager
+    def profile_request(self, tag: str = "generate"):
+        slot = self._take_slot() if self._session is not None else None
+        if slot is None:
+            yield
+            return
+        idx, session = slot
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+
+        with profile(activities=activities, record_shapes=True) as prof:
+            yield
+
+        prof.export_chrome_trace(os.path.join(session["path"], f"request-{idx}.trace.json"))
+        sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=40)
+
+        with self._lock:
+            if self._session is session:
+                session["tables"].append(f"== request {idx} ({tag}) ==\n{table}")
+        self.maybe_finish()
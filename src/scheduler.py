@@ -0,0 +1,183 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+
+LANES = ("interactive", "batch")
+
+
+class QueueFull(Exception):
+    """Global queue bound reached (maps to 503)."""
+    def __init__(self, retry_after: int):
+        super().__init__(f"generation queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class RateLimited(Exception):
+    """Per-key in-flight limit reached (maps to 429)."""
+    def __init__(self, retry_after: int):
+        super().__init__(f"too many in-flight requests for this key, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Request deadline passed before generation could start (maps to 504)."""
+
+
+class _Job:
+    __slots__ = ("fn", "key", "lane", "deadline", "future", "started", "enqueued_at")
+
+    def __init__(self, fn: Callable[[], Awaitable[Any]], key: str, lane: str, deadline: float):
+        self.fn = fn
+        self.key = key
+        self.lane = lane
+        self.deadline = deadline
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.started = asyncio.Event()  # set by the worker right before fn runs
+        self.enqueued_at = time.monotonic()
+
+
+class GenerationScheduler:
+    """
+    Bounded, deadline-aware queue in front of the model.
+
+    - lanes: "interactive" is always served before "batch", except that one
+      batch job is let through after `batch_every` interactive jobs in a row
+      so batch traffic cannot starve completely.
+    - fairness: inside a lane, keys (user / API key) are served round-robin,
+      so one client's burst only delays that client.
+    - admission: more than `max_queue` queued jobs -> QueueFull, more than
+      `max_per_key` queued + running jobs for one key -> RateLimited.
+    - deadlines: a job whose deadline passes while queued is dropped without
+      running; work that already started is not interrupted.
+    """
+    def __init__(self, workers: int = 1, max_queue: int = 64, max_per_key: int = 4, batch_every: int = 8):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_key = max_per_key
+        self.batch_every = batch_every
+
+        self._lanes: Dict[str, "OrderedDict[str, Deque[_Job]]"] = {lane: OrderedDict() for lane in LANES}
+        self._queued = 0
+        self._running = 0
+        self._per_key: Dict[str, int] = {}
+        self._interactive_streak = 0
+        self._avg_service_s = 1.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queued,
+            "running": self._running,
+            "per_lane": {lane: sum(len(q) for q in keys.values()) for lane, keys in self._lanes.items()},
+            "avg_service_s": round(self._avg_service_s, 3),
+        }
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_service_s * (self._queued + 1) / max(1, self.workers)))
+
+    async def submit(self, fn: Callable[[], Awaitable[Any]], key: str, lane: str = "interactive",
+                     timeout_s: Optional[float] = None) -> Any:
+        if lane not in self._lanes:
+            raise ValueError(f"Unknown lane={lane}. Choose from {list(LANES)}")
+        if self._queued >= self.max_queue:
+            raise QueueFull(self.retry_after())
+        if self._per_key.get(key, 0) >= self.max_per_key:
+            raise RateLimited(self.retry_after())
+
+        deadline = time.monotonic() + timeout_s if timeout_s else math.inf
+        job = _Job(fn, key, lane, deadline)
+        self._lanes[lane].setdefault(key, deque()).append(job)
+        self._queued += 1
+        self._per_key[key] = self._per_key.get(key, 0) + 1
+        self._wakeup.set()
+
+        try:
+            if timeout_s:
+                # the deadline only bounds the wait for a worker; once started, the job runs to the end
+                started = asyncio.ensure_future(job.started.wait())
+                try:
+                    await asyncio.wait({started, job.future}, timeout=timeout_s,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    started.cancel()
+                if not job.started.is_set() and not job.future.done():
+                    raise DeadlineExceeded(f"deadline of {timeout_s:.2f}s exceeded while queued")
+            return await job.future
+        finally:
+            if not job.future.done():
+                # still queued: the worker skips cancelled jobs
+                job.future.cancel()
+
+    def _pop(self) -> Optional[_Job]:
+        interactive = self._lanes["interactive"]
+        batch = self._lanes["batch"]
+        order = ["interactive", "batch"]
+        if batch and (not interactive or self._interactive_streak >= self.batch_every):
+            order = ["batch", "interactive"]
+
+        for lane in order:
+            keys = self._lanes[lane]
+            if keys:
+                key, q = next(iter(keys.items()))
+                job = q.popleft()
+                # rotate this key to the back for round-robin across keys
+                keys.pop(key)
+                if q:
+                    keys[key] = q
+                self._queued -= 1
+                self._interactive_streak = self._interactive_streak + 1 if lane == "interactive" else 0
+                return job
+        return None
+
+    def _release(self, job: _Job) -> None:
+        n = self._per_key.get(job.key, 0) - 1
+        if n > 0:
+            self._per_key[job.key] = n
+        else:
+            self._per_key.pop(job.key, None)
+
+    async def _worker(self) -> None:
+        while True:
+            job = self._pop()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if job.future.done():
+                self._release(job)
+                continue
+            if time.monotonic() > job.deadline:
+                job.future.set_exception(DeadlineExceeded("deadline exceeded while queued"))
+                self._release(job)
+                continue
+
+            job.started.set()
+            self._running += 1
+            started = time.monotonic()
+            try:
+                result = await job.fn()
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._running -= 1
+                self._release(job)
+                self._avg_service_s = 0.8 * self._avg_service_s + 0.2 * (time.monotonic() - started)
@@ -1,17 +1,25 @@
 import argparse
+import asyncio
+import os
 
 import uvicorn
 
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+from typing import List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 
 from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
 
 from pipeline.embedding import Embedder
-from pipeline.milvus import Milvus
-from model import generate as gen, build_rag_context_block
+from pipeline.milvus import Milvus, overlay_collection_name
+from pipeline.overlay import OverlayIndexer
+from pipeline.projection import load_projection
+from pipeline.symbols import SymbolIndex, identifiers_near_cursor, cursor_partial_word
+from stopping import COMPLETION_MODES
+from scheduler import GenerationScheduler, LANES, QueueFull, RateLimited, DeadlineExceeded
+from profiling import Profiler
+from model import generate as gen
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,20 +28,84 @@ milvus_host = "127.0.0.1"
 milvus_port = "19530"
 milvus_collection = "code_chunks"
 milvus_metric = "IP"
+milvus_index_type = "HNSW"
+milvus_vector_dtype = "FLOAT_VECTOR"
+milvus_layout = "flat"
 dim = 768
 model_path = "krlvi/sentence-t5-base-nlpl-code_search_net"
+symbol_index_path = os.getenv("SYMBOL_INDEX_PATH", "symbols.db")
+
+queue_max = 64
+queue_max_per_key = 4
+# default deadlines when the request does not set deadline_ms
+lane_deadline_s = {"interactive": 5.0, "batch": 120.0}
+# longer interactive requests are moved to the batch lane
+interactive_max_new_tokens = 512
+
+# per-user overlay of files saved since the last CI ingest (POST /ingest)
+overlay_debounce_s = 1.0
+# "key:user,key2:user2": clients send X-API-Key and can only read (/generate) or write (/ingest)
+# the overlay of that user; /generate is queued fairly per key user (otherwise per IP).
+# With no keys, overlays are loopback-only.
+ingest_api_keys = dict(
+    kv.strip().split(":", 1) for kv in os.getenv("INGEST_API_KEYS", "").split(",") if ":" in kv
+)
+ingest_max_chars = int(os.getenv("INGEST_MAX_CHARS", "1000000"))
+ingest_max_pending = int(os.getenv("INGEST_MAX_PENDING", "1000"))
+
+# /admin/profile is only mounted when enabled; with no ADMIN_TOKEN it accepts loopback clients only
+profiling_enabled = os.getenv("ENABLE_PROFILING", "0") == "1"
+profile_dir = os.getenv("PROFILE_DIR", "profiles")
+admin_token = os.getenv("ADMIN_TOKEN", "")
+
+# with a projection, keep full-dim vectors (mmap'd side collection) for rag_rerank_candidates;
+# ingestion must run with the same setting. Off: rerank requests fall back to a plain search.
+rerank_store = os.getenv("RAG_RERANK_STORE", "0") == "1"
+
+
+def scheduler_busy() -> bool:
+    stats = app.state.scheduler.stats()
+    return stats["queued"] + stats["running"] > 0
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.state.milvus = Milvus(host=milvus_host, port=milvus_port)
-    app.state.embedder = Embedder(dim=dim, model_path=model_path)
+    app.state.embedder = Embedder(dim=dim, model_path=model_path, projection=load_projection(milvus_collection))
     app.state.col = app.state.milvus.ensure_collection(
         name=milvus_collection,
-        dim=dim,
+        dim=app.state.embedder.dim,
+        metric=milvus_metric,
+        index_type=milvus_index_type,
+        vector_dtype=milvus_vector_dtype,
+        layout=milvus_layout,
+    )
+    app.state.overlay_col = app.state.milvus.ensure_collection(
+        name=overlay_collection_name(milvus_collection),
+        dim=app.state.embedder.dim,
         metric=milvus_metric,
+        index_type=milvus_index_type,
+        vector_dtype=milvus_vector_dtype,
+    )
+    if rerank_store and app.state.embedder.projection is not None:
+        for c in (app.state.col, app.state.overlay_col):
+            app.state.milvus.ensure_full_vectors(c, dim=app.state.embedder.projection.in_dim)
+    app.state.symbols = SymbolIndex(symbol_index_path, read_only=True) if os.path.exists(symbol_index_path) else None
+    app.state.scheduler = GenerationScheduler(workers=1, max_queue=queue_max, max_per_key=queue_max_per_key)
+    app.state.scheduler.start()
+    # overlay indexing waits while generations are queued or running
+    app.state.overlay = OverlayIndexer(
+        app.state.milvus, app.state.overlay_col, app.state.embedder,
+        debounce_s=overlay_debounce_s, busy=scheduler_busy,
     )
+    app.state.overlay.start()
+    app.state.profiler = Profiler(enabled=profiling_enabled, out_dir=profile_dir)
     yield
+    await app.state.scheduler.stop()
+    app.state.overlay.stop()
+    app.state.profiler.finish()
+    if app.state.symbols is not None:
+        app.state.symbols.close()
 
 
 app = FastAPI(title="llm-coding-copilot", lifespan=lifespan)
@@ -47,6 +119,20 @@ class GenerateRequest(BaseModel):
     top_p: float = Field(0.95, ge=0.0, le=1.0)
     do_sample: Optional[bool] = Field(None, description="If omitted, inferred from temperature")
     extra_stop: List[str] = Field(default_factory=list)
+    mode: str = Field("auto", description="line | block | multi, or auto to infer from the cursor context")
+    file_language: Optional[str] = Field(
+        None, description="Language of the edited file (VS Code languageId or extension); enables syntax-aware stopping",
+    )
+    n: int = Field(1, ge=1, le=8, description="Number of sampled candidates sharing one prefill (n > 1 always samples)")
+    prompt_token_budget: Optional[int] = Field(
+        None, ge=64, le=32768,
+        description="Max prompt tokens for context + prefix + suffix; server default if omitted",
+    )
+    priority: str = Field("interactive", description="interactive (inline completions) | batch (eval / bulk traffic)")
+    deadline_ms: Optional[int] = Field(None, ge=1, description="Drop the request if it has not started by then")
+    user: Optional[str] = Field(
+        None, description="Overlay owner; with INGEST_API_KEYS taken from X-API-Key and must match it if sent",
+    )
 
     use_rag: bool = Field(True, description="Whether to retrieve internal code context")
     rag_threshold: float = Field(0.45, ge=-1.0, le=1.0, description="Min similarity score to include chunks")
@@ -55,20 +141,52 @@ class GenerateRequest(BaseModel):
     branch: Optional[str] = Field(None, description="Branch filter (optional)")
     language: Optional[str] = Field(None, description="Language filter, e.g. python")
     exclude_file_path: Optional[str] = Field(None, description="Exclude current file path from retrieval")
+    use_overlay: bool = Field(True, description="Merge the user's overlay (files saved via /ingest) into retrieval")
+    use_symbols: bool = Field(True, description="Inject definitions of identifiers near the cursor")
+    symbol_top_k: int = Field(4, ge=1, le=16, description="Max definitions to inject")
+    rag_search_effort: Optional[int] = Field(
+        None, ge=1, le=4096,
+        description="ANN search effort (ef for HNSW, nprobe for IVF_*, search_list for DISKANN); index default if omitted",
+    )
+    rag_rerank_candidates: int = Field(
+        0, ge=0, le=100,
+        description="With a reduced-dim collection and RAG_RERANK_STORE, rescore this many ANN candidates "
+                    "with their full-dim vectors (0 = off)",
+    )
 
 
-class GenerateResponse(BaseModel):
+class IngestRequest(BaseModel):
+    user: Optional[str] = Field(
+        None, description="Overlay owner, the `user` sent with /generate; with INGEST_API_KEYS taken from X-API-Key",
+    )
+    repo: str = Field(..., min_length=1, description="Repo id the main index uses for this repo")
+    file_path: str = Field(..., min_length=1, description="Path relative to the repo root")
+    content: Optional[str] = Field(
+        None, max_length=ingest_max_chars, description="File text as saved; omit with deleted=true",
+    )
+    deleted: bool = Field(False, description="The file was deleted in the working tree")
+
+
+class ProfileRequest(BaseModel):
+    requests: int = Field(1, ge=1, le=20, description="Profile the next N generations")
+    seconds: float = Field(60.0, gt=0.0, le=120.0, description="Stop profiling after T seconds")
+
+
+class Candidate(BaseModel):
     completion: str
-    finish_reason: str  # "stop" | "length"
+    finish_reason: str
+    mean_logprob: float
 
 
-@app.post("/generate", response_model=GenerateResponse)
-async def generate(req: GenerateRequest) -> JSONResponse:
-    if not req.prefix:
-        raise HTTPException(status_code=400, detail="prefix must be non-empty")
+class GenerateResponse(BaseModel):
+    completion: str
+    finish_reason: str  # "stop" | "length"
+    mode: str  # completion mode actually used
+    candidates: List[Candidate]  # deduplicated, best mean log-prob first
 
-    do_sample = req.do_sample if req.do_sample is not None else (req.temperature > 0.0)
 
+def build_context(req: GenerateRequest, overlay_user: Optional[str] = None) -> Tuple[List[dict], List[dict]]:
+    """(symbol definitions, retrieved chunks); the prompt builder fits them to the token budget."""
     prefix = req.prefix
     suffix = req.suffix or ""
 
@@ -76,6 +194,18 @@ async def generate(req: GenerateRequest) -> JSONResponse:
     col = app.state.col
     embedder = app.state.embedder
 
+    defs: List[dict] = []
+    hits: List[dict] = []
+    symbols = app.state.symbols
+    if req.use_symbols and symbols is not None:
+        defs = symbols.lookup(
+            identifiers_near_cursor(prefix, suffix),
+            repo=req.repo,
+            partial=cursor_partial_word(prefix),
+            exclude_file_path=req.exclude_file_path,
+            limit=req.symbol_top_k,
+        )
+
     if req.use_rag:
         query_text = prefix[-2000:]
 
@@ -89,23 +219,174 @@ async def generate(req: GenerateRequest) -> JSONResponse:
             branch=req.branch,
             language=req.language,
             exclude_file_path=req.exclude_file_path,
+            search_effort=req.rag_search_effort,
+            rerank_candidates=req.rag_rerank_candidates,
+            overlay=app.state.overlay_col if overlay_user else None,
+            user=overlay_user,
         )
 
-        if hits:
-            ctx = build_rag_context_block(hits)
-            prefix = ctx + prefix
-
-    completion, finish_reason = await gen(
-        prefix,
-        suffix,
-        req.max_new_tokens,
-        req.temperature,
-        req.top_p,
-        do_sample,
-        req.extra_stop,
-    )
+    return defs, hits
+
+
+def api_key_user(request: Request) -> Optional[str]:
+    """User bound to the request's X-API-Key, None without a configured, matching key."""
+    return ingest_api_keys.get(request.headers.get("x-api-key", "")) if ingest_api_keys else None
+
+
+def is_loopback(request: Request) -> bool:
+    return bool(request.client) and request.client.host in {"127.0.0.1", "::1", "localhost"}
+
+
+def overlay_owner(request: Request, user: Optional[str]) -> Optional[str]:
+    """
+    Whose overlay a request may read or write: with INGEST_API_KEYS the user
+    bound to its X-API-Key (a different `user` is rejected), without keys the
+    `user` it names, for loopback clients only.
+    """
+    if ingest_api_keys:
+        owner = api_key_user(request)
+        if owner is None:
+            raise HTTPException(status_code=403, detail="invalid API key")
+        if user and user != owner:
+            raise HTTPException(status_code=403, detail="API key does not belong to this user")
+        return owner
+    if not is_loopback(request):
+        raise HTTPException(status_code=403, detail="overlays are loopback-only without INGEST_API_KEYS")
+    return user
+
+
+def fairness_key(request: Request) -> str:
+    # only a verified key identifies a client; body fields and unknown keys can be rotated at will
+    owner = api_key_user(request)
+    if owner is not None:
+        return f"user:{owner}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+@app.post("/generate", response_model=GenerateResponse)
+async def generate(req: GenerateRequest, request: Request) -> JSONResponse:
+    if not req.prefix:
+        raise HTTPException(status_code=400, detail="prefix must be non-empty")
+    if req.mode not in COMPLETION_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {sorted(COMPLETION_MODES)}")
+    if req.priority not in LANES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {list(LANES)}")
+
+    lane = req.priority
+    if lane == "interactive" and req.max_new_tokens > interactive_max_new_tokens:
+        lane = "batch"
+    deadline_s = req.deadline_ms / 1000.0 if req.deadline_ms else lane_deadline_s[lane]
+
+    do_sample = req.do_sample if req.do_sample is not None else (req.temperature > 0.0)
+
+    # an overlay is the owner's unmerged code: only read it for an authenticated (or local) caller
+    overlay_user = None
+    if req.use_overlay and (req.user or api_key_user(request) is not None):
+        overlay_user = overlay_owner(request, req.user)
+
+    async def run():
+        # retrieval runs inside the admitted job, so rejected requests cost no embedding or search
+        context_symbols, context_hits = await asyncio.to_thread(build_context, req, overlay_user)
+        return await gen(
+            req.prefix,
+            req.suffix or "",
+            req.max_new_tokens,
+            req.temperature,
+            req.top_p,
+            do_sample,
+            req.extra_stop,
+            context_symbols=context_symbols,
+            context_hits=context_hits,
+            prompt_token_budget=req.prompt_token_budget,
+            mode=req.mode,
+            n=req.n,
+            language=req.file_language,
+            profiler=app.state.profiler,
+        )
+
+    try:
+        candidates, mode = await app.state.scheduler.submit(
+            run, key=fairness_key(request), lane=lane, timeout_s=deadline_s,
+        )
+    except RateLimited as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+    best = candidates[0]
+    return JSONResponse({
+        "completion": best["completion"],
+        "finish_reason": best["finish_reason"],
+        "mode": mode,
+        "candidates": candidates,
+    })
+
+
+@app.post("/ingest", status_code=202)
+async def ingest(req: IngestRequest, request: Request) -> JSONResponse:
+    user = overlay_owner(request, req.user)
+    if not user:
+        raise HTTPException(status_code=400, detail="user is required")
+    if app.state.overlay.stats()["pending"] >= ingest_max_pending:
+        raise HTTPException(status_code=503, detail="too many files waiting to be indexed", headers={"Retry-After": "5"})
+    if req.content is None and not req.deleted:
+        raise HTTPException(status_code=400, detail="content is required unless deleted=true")
+    file_path = req.file_path.replace("\\", "/").lstrip("/")
+    content = None if req.deleted else req.content
+    pending = app.state.overlay.submit(user, req.repo, file_path, lambda: content)
+    return JSONResponse({"queued": True, "pending": pending}, status_code=202)
+
+
+@app.delete("/ingest")
+async def clear_overlay(request: Request, user: Optional[str] = None, repo: Optional[str] = None) -> JSONResponse:
+    """Drop a user's overlay, e.g. once CI has ingested their merged changes."""
+    user = overlay_owner(request, user)
+    if not user:
+        raise HTTPException(status_code=400, detail="user is required")
+    await asyncio.to_thread(app.state.milvus.clear_overlay, app.state.overlay_col, user, repo)
+    return JSONResponse({"cleared": True})
+
+
+@app.get("/ingest")
+async def ingest_stats(request: Request) -> JSONResponse:
+    overlay_owner(request, None)
+    return JSONResponse(app.state.overlay.stats())
+
+
+@app.get("/queue")
+async def queue_stats() -> JSONResponse:
+    return JSONResponse(app.state.scheduler.stats())
+
+
+def check_admin(request: Request) -> None:
+    if not profiling_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if admin_token:
+        if request.headers.get("x-admin-token") != admin_token:
+            raise HTTPException(status_code=403, detail="invalid admin token")
+    elif not is_loopback(request):
+        raise HTTPException(status_code=403, detail="admin endpoints are loopback-only without ADMIN_TOKEN")
+
+
+@app.post("/admin/profile")
+async def arm_profiler(body: ProfileRequest, request: Request) -> JSONResponse:
+    check_admin(request)
+    profiler = app.state.profiler
+    profiler.maybe_finish()
+    try:
+        status = await asyncio.to_thread(profiler.arm, body.requests, body.seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return JSONResponse(status)
+
 
-    return JSONResponse({"completion": completion, "finish_reason": finish_reason})
+@app.get("/admin/profile")
+async def profiler_status(request: Request) -> JSONResponse:
+    check_admin(request)
+    app.state.profiler.maybe_finish()
+    return JSONResponse(app.state.profiler.status())
 
 
 if __name__ == "__main__":
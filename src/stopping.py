@@ -0,0 +1,240 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+COMPLETION_MODES = {"auto", "line", "block", "multi"}
+
+OPENERS = {"(": ")", "[": "]", "{": "}"}
+CLOSERS = {v: k for k, v in OPENERS.items()}
+BLOCK_HEADER_ENDINGS = (":", "{")
+
+# Comment and string syntax per language family. "quotes" end at a newline,
+# "multiline_quotes" do not; multi-char delimiters are matched first.
+LANGUAGE_SYNTAX: Dict[str, Dict[str, Any]] = {
+    "python": {"line": ("#",), "quotes": ('"', "'"), "multiline_quotes": ('"""', "'''")},
+    "hash": {"line": ("#",), "quotes": ('"', "'")},
+    "c": {"line": ("//",), "block": ("/*", "*/"), "quotes": ('"', "'")},
+    "js": {"line": ("//",), "block": ("/*", "*/"), "quotes": ('"', "'"), "multiline_quotes": ("`",)},
+    # ' also starts lifetimes ('a), so only " delimits strings
+    "rust": {"line": ("//",), "block": ("/*", "*/"), "quotes": ('"',)},
+    "php": {"line": ("//", "#"), "block": ("/*", "*/"), "quotes": ('"', "'")},
+}
+
+# VS Code languageIds and file extensions -> LANGUAGE_SYNTAX family
+LANGUAGE_ALIASES: Dict[str, str] = {
+    **{k: "python" for k in ("python", "py", "pyi")},
+    **{k: "hash" for k in ("ruby", "rb", "shellscript", "sh", "bash", "zsh", "yaml", "yml", "toml",
+                           "r", "perl", "pl", "dockerfile", "makefile", "cmake")},
+    **{k: "c" for k in ("c", "h", "cpp", "cc", "cxx", "hpp", "hh", "csharp", "cs", "java", "kotlin", "kt",
+                        "kts", "swift", "scala", "dart", "groovy", "objective-c", "m")},
+    **{k: "js" for k in ("javascript", "js", "mjs", "cjs", "javascriptreact", "jsx", "typescript", "ts",
+                         "mts", "cts", "typescriptreact", "tsx", "go")},
+    **{k: "rust" for k in ("rust", "rs")},
+    "php": "php",
+}
+
+# unknown language: strings only, no comment syntax
+DEFAULT_SYNTAX: Dict[str, Any] = {"quotes": ('"', "'")}
+
+
+def language_syntax(language: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Syntax for a VS Code languageId or file extension, None if unknown."""
+    if not language:
+        return None
+    family = LANGUAGE_ALIASES.get(language.strip().lower().lstrip("."))
+    return LANGUAGE_SYNTAX[family] if family else None
+
+
+def _indent(line: str) -> int:
+    return len(line.expandtabs(4)) - len(line.expandtabs(4).lstrip())
+
+
+def _last_nonblank_line(text: str) -> str:
+    for line in reversed(text.split("\n")):
+        if line.strip():
+            return line
+    return ""
+
+
+def _first_nonblank_line(text: str) -> str:
+    for line in text.split("\n"):
+        if line.strip():
+            return line
+    return ""
+
+
+def iter_brackets(text: str, syntax: Optional[Dict[str, Any]] = None) -> Iterator[Tuple[int, str]]:
+    """
+    (index, char) of each bracket outside strings and comments. Heuristic
+    only: good enough to see whether the cursor sits inside a call.
+    """
+    syntax = syntax or DEFAULT_SYNTAX
+    line_comments = syntax.get("line", ())
+    block = syntax.get("block")
+    multiline_quotes = syntax.get("multiline_quotes", ())
+    quotes = syntax.get("quotes", ())
+
+    quote: Optional[str] = None
+    multiline = False
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == "\\":
+                i += 2
+                continue
+            if text.startswith(quote, i):
+                i += len(quote)
+                quote = None
+                continue
+            if ch == "\n" and not multiline:
+                quote = None
+            i += 1
+            continue
+
+        if block and text.startswith(block[0], i):
+            end = text.find(block[1], i + len(block[0]))
+            if end == -1:
+                return
+            i = end + len(block[1])
+            continue
+        if any(text.startswith(c, i) for c in line_comments):
+            nl = text.find("\n", i)
+            if nl == -1:
+                return
+            i = nl + 1
+            continue
+
+        opened = next((q for q in multiline_quotes if text.startswith(q, i)), None)
+        if opened:
+            quote, multiline = opened, True
+            i += len(opened)
+            continue
+        if ch in quotes:
+            quote, multiline = ch, False
+        elif ch in OPENERS or ch in CLOSERS:
+            yield i, ch
+        i += 1
+
+
+def bracket_depth(text: str, syntax: Optional[Dict[str, Any]] = None) -> int:
+    """Net count of unclosed brackets (iter_brackets)."""
+    return sum(1 if ch in OPENERS else -1 for _, ch in iter_brackets(text, syntax))
+
+
+def infer_mode(prefix: str, suffix: str) -> str:
+    line_before = prefix.rsplit("\n", 1)[-1]
+    line_after = suffix.split("\n", 1)[0]
+
+    if line_after.strip():
+        # cursor inside a line: fill the gap only
+        return "line"
+    if line_before.strip():
+        return "block" if line_before.rstrip().endswith(BLOCK_HEADER_ENDINGS) else "line"
+    # cursor on an empty / indent-only line: write the rest of the block
+    return "block"
+
+
+class CompletionStopper:
+    """
+    Text-level stopping rules for one completion, derived from the cursor
+    position. `find_cut(text)` returns the index at which the generated text
+    should end, or None to keep decoding.
+
+      line  - end at the first newline once the generated brackets are balanced
+      block - end when a new line dedents below the cursor's block
+      multi - only the suffix-repeat and unbalanced-closer rules
+
+    All modes end when the text starts repeating the suffix; with a known
+    `language` (VS Code languageId or file extension) also when it closes a
+    bracket that was never opened. Without one, comments cannot be told from
+    code, so that rule is off.
+    """
+    def __init__(self, prefix: str, suffix: str, mode: str = "auto", lookback_chars: int = 4000,
+                 language: Optional[str] = None):
+        if mode not in COMPLETION_MODES:
+            raise ValueError(f"Unsupported mode={mode}. Choose from {sorted(COMPLETION_MODES)}")
+        self.mode = infer_mode(prefix, suffix) if mode == "auto" else mode
+
+        line_before = prefix.rsplit("\n", 1)[-1]
+        if line_before.strip():
+            base = _indent(line_before)
+            # after a block header the body is deeper; the block ends at the header's level
+            self.block_indent = base + 1 if line_before.rstrip().endswith(BLOCK_HEADER_ENDINGS) else base
+        elif line_before:
+            self.block_indent = _indent(line_before)
+        else:
+            prev = _last_nonblank_line(prefix)
+            self.block_indent = _indent(prev) + (1 if prev.rstrip().endswith(BLOCK_HEADER_ENDINGS) else 0)
+
+        self.syntax = language_syntax(language)
+        self.prefix_depth = max(0, bracket_depth(prefix[-lookback_chars:], self.syntax))
+
+        line_after = suffix.split("\n", 1)[0]
+        self.suffix_same_line = line_after.strip()
+        self.suffix_next_line = _first_nonblank_line(suffix.split("\n", 1)[1] if "\n" in suffix else "").strip()
+
+    def _unbalanced_closer(self, text: str) -> Optional[int]:
+        if self.syntax is None:
+            return None
+        depth = self.prefix_depth
+        for i, ch in iter_brackets(text, self.syntax):
+            depth += 1 if ch in OPENERS else -1
+            if depth < 0:
+                return i
+        return None
+
+    def _suffix_repeat(self, text: str) -> Optional[int]:
+        if self.suffix_same_line:
+            first = text.split("\n", 1)[0].rstrip()
+            if first.endswith(self.suffix_same_line):
+                cut = len(first) - len(self.suffix_same_line)
+                # "foo(a)" before a ")" suffix is a finished call, not a repeat
+                if bracket_depth(first[:cut], self.syntax) <= 0:
+                    return cut
+        if self.suffix_next_line and len(self.suffix_next_line) >= 4:
+            pos = 0
+            for line in text.split("\n")[:-1]:
+                if pos > 0 and line.strip() == self.suffix_next_line:
+                    return pos
+                pos += len(line) + 1
+        return None
+
+    def _line_end(self, text: str) -> Optional[int]:
+        pos = 0
+        for line in text.split("\n")[:-1]:
+            end = pos + len(line)
+            if text[:end].strip() and bracket_depth(text[:end], self.syntax) <= 0:
+                return end
+            pos = end + 1
+        return None
+
+    def _dedent(self, text: str) -> Optional[int]:
+        lines = text.split("\n")
+        pos = len(lines[0]) + 1
+        # the first line continues the cursor line; later lines are judged as soon as
+        # their indentation is known (first non-blank char)
+        for line in lines[1:]:
+            if line.strip() and _indent(line) < self.block_indent and bracket_depth(text[:pos], self.syntax) <= 0:
+                return pos - 1
+            pos += len(line) + 1
+        return None
+
+    def find_cut(self, text: str) -> Optional[int]:
+        cuts: List[int] = []
+        for rule in (self._unbalanced_closer, self._suffix_repeat):
+            c = rule(text)
+            if c is not None:
+                cuts.append(c)
+        if self.mode == "line":
+            c = self._line_end(text)
+            if c is not None:
+                cuts.append(c)
+        elif self.mode == "block":
+            c = self._dedent(text)
+            if c is not None:
+                cuts.append(c)
+        return min(cuts) if cuts else None
+
+    def apply(self, text: str) -> str:
+        cut = self.find_cut(text)
+        return text if cut is None else text[:cut]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules under src/ are imported top-level (`import stopping`), as the service does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from scheduler import DeadlineExceeded, GenerationScheduler
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_started_job_outlives_its_deadline():
+    async def main():
+        sched = GenerationScheduler(workers=1)
+        sched.start()
+
+        async def slow():
+            await asyncio.sleep(0.2)
+            return "done"
+
+        try:
+            return await sched.submit(slow, key="a", timeout_s=0.05)
+        finally:
+            await sched.stop()
+
+    assert run(main()) == "done"
+
+
+def test_queued_job_past_its_deadline_is_dropped():
+    async def main():
+        sched = GenerationScheduler(workers=1)
+        sched.start()
+        ran = []
+
+        async def slow():
+            await asyncio.sleep(0.2)
+            return "first"
+
+        async def second():
+            ran.append(True)
+            return "second"
+
+        first = asyncio.create_task(sched.submit(slow, key="a"))
+        await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(DeadlineExceeded):
+                await sched.submit(second, key="b", timeout_s=0.05)
+            assert await first == "first"
+            await asyncio.sleep(0.01)
+        finally:
+            await sched.stop()
+        return ran
+
+    assert run(main()) == []
+
+
+def test_job_errors_reach_the_caller():
+    async def main():
+        sched = GenerationScheduler(workers=1)
+        sched.start()
+
+        async def boom():
+            raise RuntimeError("boom")
+
+        try:
+            with pytest.raises(RuntimeError):
+                await sched.submit(boom, key="a", timeout_s=1.0)
+        finally:
+            await sched.stop()
+
+    run(main())
+
+
+def test_stats_count_the_running_job():
+    async def main():
+        sched = GenerationScheduler(workers=1)
+        sched.start()
+        seen = []
+
+        async def job():
+            seen.append(sched.stats())
+            return None
+
+        try:
+            await sched.submit(job, key="a")
+            after = sched.stats()
+        finally:
+            await sched.stop()
+        return seen[0], after
+
+    during, after = run(main())
+    assert (during["queued"], during["running"]) == (0, 1)
+    assert after["running"] == 0
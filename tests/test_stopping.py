@@ -0,0 +1,54 @@
+from stopping import CompletionStopper, bracket_depth, language_syntax
+
+
+JS = language_syntax("javascript")
+PY = language_syntax("python")
+
+
+def test_apostrophe_in_line_comment_does_not_hide_brackets():
+    prefix = "// don't retry here\nconst r = fetch("
+    stopper = CompletionStopper(prefix, "", mode="multi", language="javascript")
+    assert stopper.prefix_depth == 1
+    assert stopper.apply("url, opts);") == "url, opts);"
+
+
+def test_unbalanced_closer_off_for_unknown_language():
+    stopper = CompletionStopper("x = f(", "", mode="multi")
+    assert stopper.apply("a))\nmore") == "a))\nmore"
+    stopper = CompletionStopper("x = f(", "", mode="multi", language="cobol")
+    assert stopper.apply("a))\nmore") == "a))\nmore"
+
+
+def test_unbalanced_closer_cuts_stray_bracket():
+    stopper = CompletionStopper("x = f(", "", mode="multi", language="py")
+    assert stopper.apply("a))\nmore") == "a)"
+
+
+def test_single_quoted_string_ends_at_newline():
+    assert bracket_depth("print('oops\nfoo(", PY) == 2
+    assert bracket_depth('s = "unterminated\nbar(', JS) == 1
+
+
+def test_multiline_strings_keep_brackets_inside():
+    assert bracket_depth('x = """(\n(\n"""\nf(', PY) == 1
+    assert bracket_depth("const s = `(\n(`;\nf(", JS) == 1
+
+
+def test_comments_per_language():
+    assert bracket_depth("# call(\nf(", PY) == 1
+    assert bracket_depth("/* (( */ f(", JS) == 1
+    assert bracket_depth("// (\nf(", JS) == 1
+    # `//` is floor division in Python, not a comment
+    assert bracket_depth("n = (a // 2", PY) == 1
+
+
+def test_strings_hide_brackets():
+    assert bracket_depth("f(')', \"(\")", PY) == 0
+    assert bracket_depth("f('\\')')", PY) == 0
+
+
+def test_language_aliases():
+    assert language_syntax("typescriptreact") is JS
+    assert language_syntax(".py") is PY
+    assert language_syntax("") is None
+    assert language_syntax("plaintext") is None